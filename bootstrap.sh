@@ -85,6 +85,7 @@ if [ "$1" == "--deployed" ]; then
 	# Install cron jobs.
 	sudo rm -f /etc/cron.daily/local
 	sudo ln -s `pwd`/bin/cron-daily /etc/cron.daily/local
+	echo "*/5 * * * * `whoami` `pwd`/bin/cron-frequent" | sudo tee /etc/cron.d/itfsite > /dev/null
 fi
 
 # LOCAL ONLY
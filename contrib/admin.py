@@ -86,7 +86,7 @@ class ActionAdmin(admin.ModelAdmin):
 
 class PledgeAdmin(admin.ModelAdmin):
     list_display = ['id', 'status', 'trigger', 'user_or_email', 'amount', 'created']
-    readonly_fields = ['user', 'trigger', 'amount', 'algorithm'] # amount is read-only because a total is cached in the Trigger
+    readonly_fields = ['user', 'trigger', 'amount', 'algorithm', 'billing_profile'] # amount is read-only because a total is cached in the Trigger
     def user_or_email(self, obj):
         return obj.user if obj.user else (obj.email + " (?)")
     user_or_email.short_description = 'User or Unverified Email'
@@ -127,6 +127,46 @@ class ContributionAdmin(admin.ModelAdmin):
     def trigger(self, obj):
         return obj.pledge_execution.pledge.trigger
 
+    def get_urls(self):
+        from django.conf.urls import patterns
+        urls = super(ContributionAdmin, self).get_urls()
+        return patterns('',
+            (r'^export.csv$', self.admin_site.admin_view((self.export_csv)))
+        ) + urls
+
+    def export_csv(self, request):
+        # Stream a CSV file of contributions and fees, optionally limited to
+        # a trigger (?trigger=id) and a date range (?start=YYYY-MM-DD&end=YYYY-MM-DD,
+        # end exclusive).
+        from django.http import HttpResponseBadRequest
+        from django.utils.dateparse import parse_date
+        from contrib.reports import iter_line_items, line_items_csv_response
+
+        contributions = Contribution.objects.all()
+        executions = PledgeExecution.objects.all()
+        filename = "contributions"
+        try:
+            if request.GET.get("trigger"):
+                trigger = Trigger.objects.get(id=request.GET["trigger"])
+                contributions = contributions.filter(pledge_execution__trigger_execution__trigger=trigger)
+                executions = executions.filter(trigger_execution__trigger=trigger)
+                filename += "-%d" % trigger.id
+            for param, op in (("start", "gte"), ("end", "lt")):
+                if request.GET.get(param):
+                    d = parse_date(request.GET[param])
+                    if d is None: raise ValueError("Invalid %s date." % param)
+                    contributions = contributions.filter(**{ "pledge_execution__created__" + op: d })
+                    executions = executions.filter(**{ "created__" + op: d })
+                    filename += "-" + param + "-" + d.isoformat()
+        except (ValueError, Trigger.DoesNotExist) as e:
+            return HttpResponseBadRequest(str(e))
+
+        return line_items_csv_response(
+            iter_line_items(contributions, executions),
+            lambda trigger : request.build_absolute_uri(trigger.get_absolute_url()),
+            filename + ".csv",
+            with_email=True)
+
 admin.site.register(Trigger, TriggerAdmin)
 admin.site.register(TriggerStatusUpdate, TriggerStatusUpdateAdmin)
 admin.site.register(TriggerExecution, TriggerExecutionAdmin)
@@ -1,22 +1,27 @@
-import decimal
+import decimal, copy
+import asyncio, types
 import rtyaml
 
 from django.conf import settings
 
+# The asyncio code below is written with generator-based coroutines
+# (yield from) rather than async/await, which need Python 3.5.
+coroutine = getattr(types, 'coroutine', None) or asyncio.coroutine
+
 def create_de_donation_basic_dict(pledge):
 	# Creates basic info for a Democracy Engine API call for creating
 	# a transaction (both authtest and auth+capture calls).
 	return {
-		"donor_first_name": pledge.extra['contributor']['contribNameFirst'],
-		"donor_last_name": pledge.extra['contributor']['contribNameLast'],
-		"donor_address1": pledge.extra['contributor']['contribAddress'],
-		"donor_city": pledge.extra['contributor']['contribCity'],
-		"donor_state": pledge.extra['contributor']['contribState'],
-		"donor_zip": pledge.extra['contributor']['contribZip'],
+		"donor_first_name": pledge.contrib_name_first,
+		"donor_last_name": pledge.contrib_name_last,
+		"donor_address1": pledge.contrib_address,
+		"donor_city": pledge.contrib_city,
+		"donor_state": pledge.contrib_state,
+		"donor_zip": pledge.contrib_zip,
 		"donor_email": pledge.get_email(),
 
-		"compliance_employer": pledge.extra['contributor']['contribEmployer'],
-		"compliance_occupation": pledge.extra['contributor']['contribOccupation'],
+		"compliance_employer": pledge.contrib_employer,
+		"compliance_occupation": pledge.contrib_occupation,
 
 		"email_opt_in": False,
 		"is_corporate_contribution": False,
@@ -24,11 +29,19 @@ def create_de_donation_basic_dict(pledge):
 		# use contributor info as billing info in the hopes that it might
 		# reduce DE's merchant fees, and maybe we'll get back CC verification
 		# info that might help us with data quality checks in the future?
-		"cc_first_name": pledge.extra['contributor']['contribNameFirst'],
-		"cc_last_name": pledge.extra['contributor']['contribNameLast'],
-		"cc_zip": pledge.extra['contributor']['contribZip'],
+		"cc_first_name": pledge.contrib_name_first,
+		"cc_last_name": pledge.contrib_name_last,
+		"cc_zip": pledge.contrib_zip,
 	}
 
+def cc_fingerprint(ccnum):
+	# A keyed hash of a credit card number that can be stored in an indexed
+	# column and matched exactly. Without the key it can't be used to recover
+	# or test guesses of the number, unlike a plain hash of a 16-digit number.
+	import hmac, hashlib
+	ccnum = ccnum.replace(' ', '')
+	return hmac.new(settings.CC_FINGERPRINT_KEY.encode("utf8"), ccnum.encode("ascii"), hashlib.sha256).hexdigest()
+
 def run_authorization_test(pledge, ccnum, ccexpmonth, ccexpyear, cccvc, aux_data):
 	# Runs an authorization test at the time the user is making a pledge,
 	# which tests the card info and also gets a credit card token that
@@ -39,6 +52,9 @@ def run_authorization_test(pledge, ccnum, ccexpmonth, ccexpyear, cccvc, aux_data
 	# quickly locate a Pledge by CC number (approximately).
 	pledge.cclastfour = ccnum[-4:]
 
+	# And a fingerprint of the number so we can find it exactly.
+	pledge.cc_fingerprint = cc_fingerprint(ccnum)
+
 	# Store a hashed version of the credit card number so we can
 	# do a verification if the user wants to look up a Pledge by CC
 	# info. Use Django's built-in password hashing functionality to
@@ -47,11 +63,12 @@ def run_authorization_test(pledge, ccnum, ccexpmonth, ccexpyear, cccvc, aux_data
 	# Also store the expiration date so that we can know that a
 	# card has expired prior to using the DE token.
 	from django.contrib.auth.hashers import make_password
-	pledge.extra['billing'] = {
-		'cc_num_hashed': make_password(ccnum),
-		'cc_exp_month': ccexpmonth,
-		'cc_exp_year': ccexpyear,
-	}
+	from contrib.models import BillingProfile
+	billing = BillingProfile(
+		cc_num_hashed=make_password(ccnum),
+		cc_exp_month=ccexpmonth,
+		cc_exp_year=ccexpyear,
+	)
 
 	# Logging.
 	aux_data.update({
@@ -90,80 +107,138 @@ def run_authorization_test(pledge, ccnum, ccexpmonth, ccexpyear, cccvc, aux_data
 	de_txn = DemocracyEngineAPI.create_donation(de_don_req)
 
 	# Store the transaction authorization, which contains the credit card token,
-	# into the pledge.
-	pledge.extra['billing']['authorization'] = de_txn
-	pledge.extra['billing']['de_cc_token'] = de_txn['token']
+	# with the pledge. The BillingProfile is saved when the pledge is saved.
+	billing.authorization = de_txn
+	billing.de_cc_token = de_txn['token']
+	pledge.billing_profile = billing
 
-def get_pledge_recipients(trigger, pledge):
+def get_pledge_recipients(trigger, pledge, recipient_plans=None):
 	# For pledge execution, figure out how to split the contribution
-	# across actual recipients.
-
-	from contrib.models import ActorParty, Recipient
+	# across actual recipients. Returns a list of (Recipient, Action)
+	# tuples.
+	#
+	# Every pledge with the same filters has the same recipients, so
+	# the answer comes from a RecipientPlan for the TriggerExecution.
+	# Code that handles many pledges at once passes a RecipientPlans
+	# so the plan is built just once.
+	if recipient_plans is not None:
+		plan = recipient_plans.get(trigger.execution)
+	else:
+		plan = RecipientPlan(trigger.execution)
+	return plan.get_recipients(pledge.desired_outcome, pledge.incumb_challgr, pledge.filter_party)
+
+class RecipientPlans(object):
+	"""The RecipientPlans used during one run over many pledges (e.g. a run of the pledge execution engine), by TriggerExecution."""
+
+	# Plans aren't kept beyond a run because they hold Recipients,
+	# whose active flags can change between runs.
+
+	def __init__(self):
+		import threading
+		self.plans = { }
+		self.lock = threading.Lock()
+
+	def get(self, trigger_execution):
+		# The creation time is part of the key in case a TriggerExecution
+		# is deleted and its id reused (e.g. in tests).
+		key = (trigger_execution.id, trigger_execution.created)
+		with self.lock:
+			plan = self.plans.get(key)
+			if plan is None:
+				plan = RecipientPlan(trigger_execution)
+				self.plans[key] = plan
+		return plan
+
+class RecipientPlan(object):
+	"""The recipients of pledges on a TriggerExecution for each combination of pledge filters, computed once per combination."""
+
+	def __init__(self, trigger_execution):
+		from contrib.models import Recipient
+
+		# Load all of the Actions and the Recipients for the incumbents
+		# in two queries.
+		self.actions = list(trigger_execution.actions.all().select_related('actor', 'challenger'))
+		self.incumbents = {
+			r.actor_id: r
+			for r in Recipient.objects.filter(actor__in=[a.actor_id for a in self.actions if a.outcome is not None])
+		}
+		self.plan = { }
+
+	def get_recipients(self, desired_outcome, incumb_challgr, filter_party):
+		key = (desired_outcome, incumb_challgr, filter_party)
+		if key not in self.plan:
+			# Errors are raised, and not remembered, so that every pledge
+			# that hits one fails the same way.
+			self.plan[key] = self.compute_recipients(*key)
+		return list(self.plan[key])
+
+	def compute_recipients(self, desired_outcome, incumb_challgr, filter_party):
+		from contrib.models import Recipient
+
+		recipients = []
+
+		for action in self.actions:
+			# Skip actions with null outcomes, meaning the Actor didn't really
+			# take an action and so no contribution for or against is made.
+
+			if action.outcome is None:
+				continue
 
-	recipients = []
+			# Get a recipient object.
 
-	for action in trigger.execution.actions.all().select_related('actor'):
-		# Skip actions with null outcomes, meaning the Actor didn't really
-		# take an action and so no contribution for or against is made.
+			if action.outcome == desired_outcome:
+				# The incumbent did what the user wanted, so the incumbent is the recipient.
 
-		if action.outcome is None:
-			continue
+				# Filter if the pledge is for challengers only.
+				if incumb_challgr == -1:
+					continue
 
-		# Get a recipient object.
+				# Party filtering is based on the party of the incumbent at the time of the action.
+				party = action.party
 
-		if action.outcome == pledge.desired_outcome:
-			# The incumbent did what the user wanted, so the incumbent is the recipient.
+				# Get the Recipient object.
+				try:
+					r = self.incumbents[action.actor_id]
+				except KeyError:
+					raise Recipient.DoesNotExist("There is no recipient for " + str(action.actor))
 
-			# Filter if the pledge is for challengers only.
-			if pledge.incumb_challgr == -1:
-				continue
+			else:
+				# The incumbent did something other than what the user wanted, so the
+				# challenger of the opposite party is the recipient.
 
-			# Party filtering is based on the party of the incumbent at the time of the action.
-			party = action.party
+				# Filter if the pledge is for incumbents only.
+				if incumb_challgr == 1:
+					continue
 
-			# Get the Recipient object.
-			try:
-				r = Recipient.objects.get(actor=action.actor)
-			except Recipient.DoesNotExist:
-				raise Recipient.DoesNotExist("There is no recipient for " + str(action.actor))
+				if action.challenger is None:
+					# We don't have a challenger Recipient associated. There should always
+					# be a challenger. If there is not, create a Recipient and set its
+					# active field to false.
+					raise ValueError("Action has no challenger: %s" % action)
 
-		else:
-			# The incumbent did something other than what the user wanted, so the
-			# challenger of the opposite party is the recipient.
+				# Get the Recipient object.
+				r = action.challenger
 
-			# Filter if the pledge is for incumbents only.
-			if pledge.incumb_challgr == 1:
-				continue
+				# Party filtering is based on the party on the recipient object.
+				party = r.party
 
-			if action.challenger is None:
-				# We don't have a challenger Recipient associated. There should always
-				# be a challenger. If there is not, create a Recipient and set its
-				# active field to false.
-				raise ValueError("Action has no challenger: %s" % action)
+			# The Recipient may not be currently taking contributions.
+			# This condition should be filtered out earlier in the creation
+			# of Action objects --- it should have a null outcome with
+			# explanation.
+			
+			if not r.active:
+				raise ValueError("Recipient is inactive: %s => %s" % (action, r))
 
-			# Get the Recipient object.
-			r = action.challenger
+			# Filter by party.
 
-			# Party filtering is based on the party on the recipient object.
-			party = r.party
-
-		# The Recipient may not be currently taking contributions.
-		# This condition should be filtered out earlier in the creation
-		# of Action objects --- it should have a null outcome with
-		# explanation.
-		
-		if not r.active:
-			raise ValueError("Recipient is inactive: %s => %s" % (action, r))
-
-		# Filter by party.
-
-		if pledge.filter_party is not None and party != pledge.filter_party:
-			continue
+			if filter_party is not None and party != filter_party:
+				continue
 
-		# If we got here, then r is an acceptable recipient.
-		recipients.append( (r, action) )
+			# If we got here, then r is an acceptable recipient.
+			recipients.append( (r, action) )
 
-	return recipients
+		return recipients
 
 def compute_charge(pledge, recipients):
 	# Return a tuple of:
@@ -220,6 +295,18 @@ def compute_charge(pledge, recipients):
 def create_pledge_donation(pledge, recipients):
 	# Pledge execution --- make a credit card charge and return
 	# the DE donation record and other details.
+	recip_contribs, fees, total_charge, de_don_req = build_pledge_donation(pledge, recipients)
+
+	# Create the 'donation', which creates a transaction and performs cc authorization.
+	don = DemocracyEngineAPI.create_donation(de_don_req)
+
+	# Return.
+	return (recip_contribs, fees, total_charge, don)
+
+def build_pledge_donation(pledge, recipients):
+	# Compute the charge for a pledge and build the Democracy Engine
+	# donation request for it, without making the API call. Returns
+	# the line items, fees, total charge, and the request.
 
 	# Compute the amount to charge the user. We can only make whole-penny
 	# contributions, so the exact amount of the charge may be less than
@@ -263,7 +350,7 @@ def create_pledge_donation(pledge, recipients):
 	de_don_req = create_de_donation_basic_dict(pledge)
 	de_don_req.update({
 		# billing info
-		"token": pledge.extra['billing']['de_cc_token'],
+		"token": pledge.billing_profile.de_cc_token,
 
 		# line items
 		"line_items": line_items,
@@ -286,12 +373,8 @@ def create_pledge_donation(pledge, recipients):
 	if sum(decimal.Decimal(li['amount'].replace("$", "")) for li in de_don_req['line_items']) \
 		!= total_charge:
 		raise ValueError("Sum of line items does not match total charge.")
-	
-	# Create the 'donation', which creates a transaction and performs cc authorization.
-	don = DemocracyEngineAPI.create_donation(de_don_req)
 
-	# Return.
-	return (recip_contribs, fees, total_charge, don)
+	return (recip_contribs, fees, total_charge, de_don_req)
 
 def void_pledge_transaction(txn_guid, allow_credit=False):
 	# This raises a 404 exception if the transaction info is not
@@ -326,43 +409,138 @@ class HumanReadableValidationError(Exception):
 
 class DemocracyEngineAPI(object):
 	de_meta_info = None
+	de_meta_info_checked = None
+
+	# The subscriber meta info is shared by all processes through the
+	# Django cache, where the refresh_de_meta_info management command
+	# (run at deploy and by bin/cron-frequent) keeps it fresh. Each
+	# process re-reads it from the cache every META_INFO_TTL seconds.
+	META_INFO_CACHE_KEY = "democracyengine_meta_info"
+	META_INFO_TTL = 60*5
+
+	def __init__(self):
+		import threading
+		self.local = threading.local()
+		self.stats_lock = threading.Lock()
+		self.stats = { }
+
+	def get_meta_info(self, live_request=False):
+		# Returns the subscriber meta info, which gives the URLs of the other
+		# API methods. Only blocks on a network call if no process has
+		# fetched it yet.
+		import time
+		if self.de_meta_info is None \
+			or time.time() - self.de_meta_info_checked > settings.DE_API.get('meta_info_ttl', self.META_INFO_TTL):
+			from django.core.cache import cache
+			cached = cache.get(self.META_INFO_CACHE_KEY)
+			if cached:
+				self.de_meta_info = cached["info"]
+			elif self.de_meta_info is None:
+				self.refresh_meta_info(live_request=live_request)
+			# If the cache was cleared, keep using our copy until the
+			# command puts it back.
+			self.de_meta_info_checked = time.time()
+
+		return self.de_meta_info
+
+	def refresh_meta_info(self, live_request=False):
+		# Fetch the subscriber meta info and store it in this process and in
+		# the Django cache.
+		from django.core.cache import cache
+		info = self(None, None, live_request=live_request)
+		cache.set(self.META_INFO_CACHE_KEY, { "info": info }, None)
+		self.de_meta_info = info
+
+	def get_session(self):
+		# Get a requests.Session for this process and thread. The session keeps
+		# connections to Democracy Engine alive between calls, and reusing the
+		# same HTTPDigestAuth object lets requests re-use the last Digest nonce
+		# instead of taking a 401 challenge round-trip on every call. Sessions
+		# aren't shared across a fork (e.g. uwsgi workers) or across threads.
+		import os
+		if getattr(self.local, 'pid', None) != os.getpid():
+			import requests
+			from requests.adapters import HTTPAdapter
+			from requests.auth import HTTPDigestAuth
+			from requests.packages.urllib3.util.retry import Retry
+
+			# Retry failed connections and, because they are idempotent,
+			# GET requests that fail on the server side, with exponential
+			# backoff. Charges are never retried.
+			retry_args = {
+				"total": settings.DE_API.get('max_retries', 3),
+				"backoff_factor": settings.DE_API.get('retry_backoff', 0.5),
+				"status_forcelist": [500, 502, 503, 504],
+			}
+			try:
+				retry = Retry(method_whitelist=frozenset(['GET']), **retry_args)
+			except TypeError:
+				# urllib3 >= 2 renamed the argument.
+				retry = Retry(allowed_methods=frozenset(['GET']), **retry_args)
+
+			session = requests.Session()
+			session.auth = HTTPDigestAuth(settings.DE_API['username'], settings.DE_API['password'])
+			session.mount('https://', HTTPAdapter(
+				pool_connections=1,
+				pool_maxsize=settings.DE_API.get('pool_size', 4),
+				max_retries=retry))
+			session.mount('http://', HTTPAdapter(max_retries=retry))
+
+			self.local.session = session
+			self.local.pid = os.getpid()
+		return self.local.session
+
+	def record_latency(self, method, elapsed, failed):
+		# Record per-method call counts and latency.
+		with self.stats_lock:
+			st = self.stats.setdefault(method or "META", { "count": 0, "errors": 0, "total_time": 0.0, "max_time": 0.0 })
+			st["count"] += 1
+			st["total_time"] += elapsed
+			st["max_time"] = max(st["max_time"], elapsed)
+			if failed:
+				st["errors"] += 1
+
+	def get_stats(self):
+		# Returns a dict mapping API method names to a dict of call
+		# counts and latencies.
+		with self.stats_lock:
+			ret = copy.deepcopy(self.stats)
+		for st in ret.values():
+			st["mean_time"] = st["total_time"] / st["count"]
+		return ret
 
 	def __call__(self, method, post_data=None, argument=None, live_request=False, http_method=None):
 		import json
-		import requests
-		from requests.auth import HTTPDigestAuth
-
-		# Cache meta info. If method is None, don't infinite recurse.
-		if (self.de_meta_info == None) and (method is not None):
-			self.de_meta_info = self(None, None, live_request=live_request)
+		import time
 
 		if method is None:
 			# This is an internal call to get the meta subscriber info.
 			url = settings.DE_API['api_baseurl'] + ('/subscribers/%s.json' % settings.DE_API['account_number'])
 		elif method == "META":
 			# This is a real call to get the meta info, which is always cached.
-			return self.de_meta_info
+			return self.get_meta_info(live_request=live_request)
 		else:
-			# Get the correct URL from the meta info, and do argument substitution
-			# if necessary.
-			url = self.de_meta_info[method + "_uri"]
+			# Get the correct URL from the (cached) meta info, and do argument
+			# substitution if necessary.
+			url = self.get_meta_info(live_request=live_request)[method + "_uri"]
 			if argument:
 				import urllib.parse
 				url = url.replace(":"+argument[0], urllib.parse.quote(argument[1]))
 
 		# GET or POST?
+		session = self.get_session()
 		if post_data == None:
 			payload = None
 			headers = None
-			urlopen = requests.get
+			urlopen = session.get
 		else:
 			payload = json.dumps(post_data)
 			headers = {'content-type': 'application/json'}
-			urlopen = requests.post
+			urlopen = session.post
 
 		# Override HTTP method.
 		if http_method:
-			urlopen = getattr(requests, http_method)
+			urlopen = getattr(session, http_method)
 
 		# Log requests. Definitely don't do this in production since we'll
 		# have sensitive data here!
@@ -372,15 +550,20 @@ class DemocracyEngineAPI(object):
 				print(json.dumps(json.loads(payload), indent=True))
 			print()
 
-		# issue request
-		r = urlopen(
-			url,
-			auth=HTTPDigestAuth(settings.DE_API['username'], settings.DE_API['password']),
-			data=payload,
-			headers=headers,
-			timeout=30 if not live_request else 20,
-			verify=True, # check SSL cert (is default, actually)
-			)
+		# issue request (the session provides the authentication)
+		start = time.time()
+		try:
+			r = urlopen(
+				url,
+				data=payload,
+				headers=headers,
+				timeout=30 if not live_request else 20,
+				verify=True, # check SSL cert (is default, actually)
+				)
+		except:
+			self.record_latency(method, time.time() - start, True)
+			raise
+		self.record_latency(method, time.time() - start, r.status_code != 200)
 
 		# raises exception on anything but 200 OK
 		try:
@@ -441,11 +624,17 @@ class DemocracyEngineAPI(object):
 DemocracyEngineAPI = DemocracyEngineAPI()
 
 class DummyDemocracyEngineAPI(object):
-	"""A stand-in for the DE API for unit tests."""
+	"""A stand-in for the DE API for unit tests and benchmarks, which optionally waits latency seconds on each call."""
 
 	issued_tokens = set()
 
+	def __init__(self, latency=0.0):
+		self.latency = latency
+
 	def create_donation(self, info):
+		if self.latency:
+			import time
+			time.sleep(self.latency)
 		if info.get('token_request'):
 			import random, hashlib
 			token = hashlib.md5(str(random.random()).encode('ascii')).hexdigest()
@@ -460,3 +649,78 @@ class DummyDemocracyEngineAPI(object):
 			return {
 				"dummy_response": True,
 			}
+
+class AsyncRateLimiter(object):
+	"""Spaces out the starts of calls made from asyncio code to at most rate per second."""
+
+	def __init__(self, rate):
+		self.interval = (1.0 / rate) if rate else 0.0
+		self.next_time = 0.0
+
+	@coroutine
+	def wait(self):
+		if not self.interval:
+			return
+		now = asyncio.get_event_loop().time()
+		start = max(now, self.next_time)
+		self.next_time = start + self.interval
+		if start > now:
+			yield from asyncio.sleep(start - now)
+
+class AsyncDemocracyEngineAPI(object):
+	"""Makes Democracy Engine API calls from asyncio code, with a limit on concurrent calls and an optional rate limit."""
+
+	# There's no asyncio HTTP client among our dependencies, so the calls are
+	# made by the (synchronous) DemocracyEngineAPI in a pool of threads, each
+	# with its own keep-alive session. Call close() when done to stop the
+	# threads.
+
+	def __init__(self, concurrency=8, rate=None):
+		self.concurrency = concurrency
+		self.rate_limiter = AsyncRateLimiter(rate)
+		self.semaphores = { }
+		self.executor = None
+
+	def close(self):
+		if self.executor is not None:
+			self.executor.shutdown()
+			self.executor = None
+
+	def get_semaphore(self):
+		# Semaphores belong to an event loop, so make one per loop.
+		loop = asyncio.get_event_loop()
+		if loop not in self.semaphores:
+			self.semaphores[loop] = asyncio.Semaphore(self.concurrency)
+		return self.semaphores[loop]
+
+	@coroutine
+	def call(self, method_name, *args):
+		semaphore = self.get_semaphore()
+		yield from semaphore.acquire()
+		try:
+			yield from self.rate_limiter.wait()
+			return (yield from self.run(method_name, *args))
+		finally:
+			semaphore.release()
+
+	@coroutine
+	def run(self, method_name, *args):
+		import concurrent.futures
+		if self.executor is None:
+			self.executor = concurrent.futures.ThreadPoolExecutor(self.concurrency)
+		# Look up the module-level DemocracyEngineAPI now so that unit tests
+		# can replace it.
+		method = getattr(DemocracyEngineAPI, method_name)
+		return (yield from asyncio.get_event_loop().run_in_executor(self.executor, method, *args))
+
+	def get_transaction(self, id):
+		return self.call("get_transaction", id)
+
+	def void_transaction(self, id):
+		return self.call("void_transaction", id)
+
+	def credit_transaction(self, id):
+		return self.call("credit_transaction", id)
+
+	def create_donation(self, info):
+		return self.call("create_donation", info)
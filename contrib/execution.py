@@ -0,0 +1,251 @@
+# Executes pledges in bulk using a pool of workers.
+# -------------------------------------------------
+#
+# Pledge.execute() makes a blocking call to Democracy Engine, so
+# executing pledges one at a time is slow when a trigger has many
+# pledges. The engine here runs Pledge.execute() for many pledges at
+# once in a pool of threads or processes. Each pledge is executed
+# exactly as it would be if Pledge.execute() were called directly.
+#
+# Progress is written to an optional checkpoint file (JSON, one
+# record per line) so that a crashed run can be resumed. A pledge
+# that was submitted to a worker but never finished may have had
+# its card charged without the database transaction committing,
+# and so might a pledge that failed with an unexpected error, so on
+# resume those pledges are reported and not retried unless asked.
+#
+# As when pledges are executed one at a time, an unexpected error
+# stops the run: no new pledges are started, though pledges already
+# running in other workers are allowed to finish.
+
+import json, time, threading
+
+from django.db import connections, close_old_connections
+
+# The RecipientPlans of the run this process is working on, as a tuple of
+# (run id, RecipientPlans). Each run builds its own plans, so that changes
+# to Recipients between runs are seen, and worker processes build theirs
+# on their first pledge.
+run_recipient_plans = (None, None)
+run_recipient_plans_lock = threading.Lock()
+
+def get_run_recipient_plans(run_id):
+	global run_recipient_plans
+	from contrib.bizlogic import RecipientPlans
+	with run_recipient_plans_lock:
+		if run_recipient_plans[0] != run_id:
+			run_recipient_plans = (run_id, RecipientPlans())
+		return run_recipient_plans[1]
+
+def execute_pledge(pledge_id, run_id=None):
+	# Executes a single pledge and returns a tuple of (pledge_id, result,
+	# message, elapsed seconds).
+	from contrib.models import Pledge
+
+	start = time.time()
+	try:
+		p = Pledge.objects.get(id=pledge_id)
+		p.execute(recipient_plans=get_run_recipient_plans(run_id) if run_id else None)
+		result, message = "done", None
+
+	# ValueError indicates a known condition that makes the pledge
+	# non-executable. We should skip it. Sometimes it just means
+	# we have to wait.
+	except ValueError as e:
+		result, message = "skipped", str(e)
+
+	# Any other exception is unexpected. The database transaction was
+	# rolled back, but the card may have been charged. The engine stops
+	# the run when it sees this result.
+	except Exception as e:
+		result, message = "error", "%s: %s" % (type(e).__name__, str(e))
+
+	return (pledge_id, result, message, time.time() - start)
+
+def execute_pledge_in_worker(pledge_id, run_id=None):
+	# Executes a single pledge in a pool worker. This is a module-level
+	# function so that it can be pickled and sent to a worker process.
+	try:
+		return execute_pledge(pledge_id, run_id)
+	finally:
+		# Worker threads each have their own database connection.
+		close_old_connections()
+
+class Checkpoint(object):
+	"""A log of the pledges submitted and finished by a run, for resuming after a crash."""
+
+	def __init__(self, path):
+		self.path = path
+		self.state = { }
+		self.f = None
+		if path is None:
+			return
+
+		# Load the previous run's state, if any. The last record for
+		# each pledge wins.
+		try:
+			with open(path) as f:
+				for line in f:
+					try:
+						rec = json.loads(line)
+					except ValueError:
+						continue # partially written last line
+					self.state[rec["pledge"]] = rec["state"]
+		except FileNotFoundError:
+			pass
+
+		self.f = open(path, "a")
+
+	def in_flight(self):
+		# Pledges that were submitted to a worker but never finished, or
+		# that failed with an unexpected error. Either may have been
+		# charged.
+		return set(pledge_id for pledge_id, state in self.state.items()
+			if state in ("submitted", "error"))
+
+	def record(self, pledge_id, state, message=None):
+		self.state[pledge_id] = state
+		if self.f is None:
+			return
+		rec = { "pledge": pledge_id, "state": state }
+		if message:
+			rec["message"] = message
+		self.f.write(json.dumps(rec, sort_keys=True) + "\n")
+		self.f.flush()
+
+	def close(self):
+		if self.f is not None:
+			self.f.close()
+
+class ExecutionSummary(object):
+	"""Counts and timings collected over a run."""
+
+	def __init__(self):
+		self.counts = { "done": 0, "skipped": 0, "error": 0 }
+		self.latencies = []
+		self.start = time.time()
+		self.end = None
+
+	def add(self, result, elapsed):
+		self.counts[result] += 1
+		self.latencies.append(elapsed)
+
+	def finish(self):
+		self.end = time.time()
+
+	def as_dict(self):
+		wall_time = (self.end or time.time()) - self.start
+		lat = sorted(self.latencies)
+		def pct(p):
+			if not lat: return 0.0
+			return lat[min(len(lat)-1, int(p * len(lat)))]
+		ret = {
+			"pledges": len(lat),
+			"wall_time": wall_time,
+			"throughput": len(lat) / wall_time if wall_time > 0 else 0.0,
+			"latency_mean": sum(lat) / len(lat) if lat else 0.0,
+			"latency_p50": pct(.50),
+			"latency_p95": pct(.95),
+			"latency_max": lat[-1] if lat else 0.0,
+		}
+		ret.update(self.counts)
+		return ret
+
+	def __str__(self):
+		return ("{pledges} pledges in {wall_time:.1f}s ({throughput:.2f}/s): "
+			"{done} executed, {skipped} skipped, {error} failed. "
+			"Latency mean {latency_mean:.3f}s, p50 {latency_p50:.3f}s, "
+			"p95 {latency_p95:.3f}s, max {latency_max:.3f}s.").format(**self.as_dict())
+
+class PledgeExecutionEngine(object):
+	"""Executes many pledges concurrently with a pool of threads or processes."""
+
+	def __init__(self, workers=1, processes=False, checkpoint=None, retry_in_flight=False, log=print):
+		self.workers = max(1, workers)
+		self.processes = processes
+		self.checkpoint_path = checkpoint
+		self.retry_in_flight = retry_in_flight
+		self.log = log
+
+	def run(self, pledge_ids, progress=lambda it, total : it):
+		# Executes the pledges with the given IDs and returns an
+		# ExecutionSummary.
+		import uuid
+		checkpoint = Checkpoint(self.checkpoint_path)
+		summary = ExecutionSummary()
+		run_id = uuid.uuid4().hex
+		self.stopped = False
+		try:
+			pledge_ids = self.filter_resumed(pledge_ids, checkpoint)
+
+			if self.workers == 1:
+				# Run in this thread.
+				results = self.run_serial(pledge_ids, checkpoint, run_id)
+			else:
+				results = self.run_pool(pledge_ids, checkpoint, run_id)
+
+			for pledge_id, result, message, elapsed in progress(results, len(pledge_ids)):
+				checkpoint.record(pledge_id, result, message)
+				summary.add(result, elapsed)
+				if message:
+					self.log("Pledge %d: %s" % (pledge_id, message))
+				if result == "error" and not self.stopped:
+					# Don't start any more pledges.
+					self.stopped = True
+					self.log("Stopping after an unexpected error. Pledge %d may have been charged. Check its transaction in Democracy Engine and then re-run with retry-in-flight." % pledge_id)
+		finally:
+			checkpoint.close()
+			summary.finish()
+
+		return summary
+
+	def filter_resumed(self, pledge_ids, checkpoint):
+		# Don't re-run pledges that may have been charged in a run that
+		# crashed, unless we've been told it's safe. Pledges that did
+		# commit are no longer Open, so they were filtered out by the
+		# caller already.
+		pledge_ids = list(pledge_ids)
+		in_flight = checkpoint.in_flight() & set(pledge_ids)
+		if in_flight and not self.retry_in_flight:
+			self.log("These pledges were being executed or failed with an error when a previous run stopped and may have been charged. Check their transactions in Democracy Engine and then re-run with retry-in-flight:")
+			for pledge_id in sorted(in_flight):
+				self.log("\t%d" % pledge_id)
+			pledge_ids = [pledge_id for pledge_id in pledge_ids if pledge_id not in in_flight]
+		return pledge_ids
+
+	def run_serial(self, pledge_ids, checkpoint, run_id):
+		for pledge_id in pledge_ids:
+			if self.stopped:
+				break
+			checkpoint.record(pledge_id, "submitted")
+			yield execute_pledge(pledge_id, run_id)
+
+	def run_pool(self, pledge_ids, checkpoint, run_id):
+		import concurrent.futures
+
+		if self.processes:
+			# Forked worker processes must not share the parent's database
+			# connections. Close them so each worker opens its own.
+			for conn in connections.all():
+				conn.close()
+			pool = concurrent.futures.ProcessPoolExecutor(self.workers)
+		else:
+			pool = concurrent.futures.ThreadPoolExecutor(self.workers)
+
+		# Only keep a few pledges per worker in flight at a time so that
+		# the checkpoint's "submitted" records reflect what a worker might
+		# actually be executing if we crash.
+		pending = set()
+		queue = iter(pledge_ids)
+		with pool:
+			while True:
+				while len(pending) < 2*self.workers and not self.stopped:
+					pledge_id = next(queue, None)
+					if pledge_id is None: break
+					checkpoint.record(pledge_id, "submitted")
+					pending.add(pool.submit(execute_pledge_in_worker, pledge_id, run_id))
+				if not pending:
+					break
+				done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+				for future in done:
+					yield future.result()
@@ -77,17 +77,134 @@ def create_trigger_from_bill(bill_id, chamber):
 	t.save()
 	return t
 
-def execute_trigger_from_vote(trigger, govtrack_url):
-	import requests, lxml.etree
+class GovTrackVoteSource(object):
+	"""Fetches a vote's metadata and voter list from GovTrack, keeping a local cache of the documents."""
+
+	# Fetched documents are stored by the SHA1 hash of their content in
+	# cache_dir/objects. cache_dir/urls holds, for each URL, the hash of
+	# the last response and its ETag and Last-Modified headers, which are
+	# used to revalidate the cached copy with a conditional request.
+
+	def __init__(self, govtrack_url, cache_dir=None, timeout=30, max_retries=3):
+		self.govtrack_url = govtrack_url
+		self.cache_dir = cache_dir if cache_dir is not None else settings.GOVTRACK_CACHE_DIR
+		self.timeout = timeout
+		self.max_retries = max_retries
+
+	def get_vote(self):
+		# Get vote metadata from GovTrack's API, via the undocumented
+		# '.json' extension added to vote pages.
+		import json
+		with self.open_url(self.govtrack_url + '.json') as f:
+			return json.loads(f.read().decode("utf8"))
+
+	def open_voters_xml(self):
+		# The XML export of the vote, which conveniently includes everything
+		# without limit/offset. Returns a binary file.
+		return self.open_url(self.govtrack_url + '/export/xml')
+
+	def open_url(self, url):
+		# Returns a binary file with the content at url, from the cache if
+		# GovTrack says it hasn't changed.
+		import os, os.path, json, hashlib, tempfile
+		import requests
+		from requests.adapters import HTTPAdapter
+
+		index_fn = os.path.join(self.cache_dir, "urls", hashlib.sha1(url.encode("utf8")).hexdigest() + ".json")
+		try:
+			with open(index_fn) as f:
+				index = json.load(f)
+			if not os.path.exists(self.object_path(index["sha1"])):
+				index = None
+		except (IOError, ValueError):
+			index = None
+
+		# Make a conditional request if we have a cached copy.
+		headers = { }
+		if index and index.get("etag"):
+			headers["If-None-Match"] = index["etag"]
+		if index and index.get("last_modified"):
+			headers["If-Modified-Since"] = index["last_modified"]
+
+		session = requests.Session()
+		session.mount('https://', HTTPAdapter(max_retries=self.max_retries))
+		session.mount('http://', HTTPAdapter(max_retries=self.max_retries))
+		try:
+			r = session.get(url, headers=headers, timeout=self.timeout, stream=True)
+
+			if r.status_code == 304 and index:
+				r.close()
+				return open(self.object_path(index["sha1"]), "rb")
+			r.raise_for_status()
+
+			# Save the new content as it streams in, hashing as we go, and then
+			# move it into place.
+			os.makedirs(os.path.join(self.cache_dir, "objects"), exist_ok=True)
+			os.makedirs(os.path.join(self.cache_dir, "urls"), exist_ok=True)
+			sha1 = hashlib.sha1()
+			with tempfile.NamedTemporaryFile(dir=os.path.join(self.cache_dir, "objects"), delete=False) as f:
+				try:
+					for chunk in r.iter_content(65536):
+						sha1.update(chunk)
+						f.write(chunk)
+				except:
+					os.unlink(f.name)
+					raise
+			os.replace(f.name, self.object_path(sha1.hexdigest()))
+
+		except requests.RequestException:
+			# GovTrack returned an error or didn't respond even after
+			# retries. Use the copy we have, if we have one.
+			if index:
+				return open(self.object_path(index["sha1"]), "rb")
+			raise
+
+		with open(index_fn, "w") as f:
+			json.dump({
+				"url": url,
+				"sha1": sha1.hexdigest(),
+				"etag": r.headers.get("ETag"),
+				"last_modified": r.headers.get("Last-Modified"),
+			}, f)
+
+		return open(self.object_path(sha1.hexdigest()), "rb")
+
+	def object_path(self, sha1):
+		import os.path
+		return os.path.join(self.cache_dir, "objects", sha1)
+
+class FileVoteSource(object):
+	"""A vote's metadata (JSON) and voter list (XML) from files previously saved from GovTrack."""
+
+	def __init__(self, json_fn, xml_fn):
+		self.json_fn = json_fn
+		self.xml_fn = xml_fn
+
+	def get_vote(self):
+		import json
+		with open(self.json_fn) as f:
+			return json.load(f)
+
+	def open_voters_xml(self):
+		return open(self.xml_fn, "rb")
+
+def execute_trigger_from_vote(trigger, govtrack_url, source=None):
+	# Executes the trigger using a GovTrack vote. The vote documents come
+	# from source, which defaults to GovTrack with the local cache.
+	import lxml.etree
+
+	if source is None:
+		source = GovTrackVoteSource(govtrack_url)
 
 	# Map vote keys '+' and '-' to outcome indexes.
 	outcome_index = { }
 	for i, outcome in enumerate(trigger.outcomes):
 		outcome_index[outcome['vote_key']] = i
 
-	# Get vote metadata from GovTrack's API, via the undocumented
-	# '.json' extension added to vote pages.
-	vote = requests.get(govtrack_url+'.json').json()
+	# Get vote metadata.
+	vote = source.get_vote()
+	if govtrack_url is None:
+		govtrack_url = vote['link']
 
 	# Parse the date, which is in US Eastern time. Must make it
 	# timezone-aware to store in our database.
@@ -100,40 +217,46 @@ def execute_trigger_from_vote(trigger, govtrack_url):
 	# Then get how Members of Congress voted via the XML, which conveniently
 	# includes everything without limit/offset. The congress project vote
 	# JSON doesn't use GovTrack IDs, so it's more convenient to use GovTrack
-	# data.
-	r = requests.get(govtrack_url+'/export/xml').content
-	dom = lxml.etree.fromstring(r)
-	actor_outcomes = { }
-	for voter in dom.findall('voter'):
-		# Validate.
-		if not voter.get('id'):
-			 # VP tiebreaker
-			if voter.get('VP'):
-				continue
-			raise Exception("Missing data in GovTrack XML.")
+	# data. Parse it incrementally, keeping just the vote of each voter.
+	voter_outcomes = [ ]
+	with source.open_voters_xml() as f:
+		for event, voter in lxml.etree.iterparse(f, events=('end',), tag='voter'):
+			# Validate.
+			if not voter.get('id'):
+				 # VP tiebreaker
+				if voter.get('VP'):
+					continue
+				raise Exception("Missing data in GovTrack XML.")
+
+			voter_outcomes.append((int(voter.get('id')), voter.get('vote')))
+			voter.clear()
+
+	# Get all of the Actors at once.
+	actors = { a.govtrack_id: a for a in Actor.objects.filter(govtrack_id__in=[govtrack_id for govtrack_id, vote_key in voter_outcomes]) }
 
+	actor_outcomes = { }
+	for govtrack_id, vote_key in voter_outcomes:
 		# Get the Actor.
-		try:
-			actor = Actor.objects.get(govtrack_id=voter.get('id'))
-		except Actor.DoesNotExist:
+		actor = actors.get(govtrack_id)
+		if actor is None:
 			if settings.DEBUG:
-				print("No Actor instance exists here for Member of Congress with GovTrack ID %d." % int(voter.get('id')))
+				print("No Actor instance exists here for Member of Congress with GovTrack ID %d." % govtrack_id)
 				continue
 				
-			raise Exception("No Actor instance exists here for Member of Congress with GovTrack ID %d." % int(voter.get('id')))
+			raise Exception("No Actor instance exists here for Member of Congress with GovTrack ID %d." % govtrack_id)
 
 		# Map vote keys '+' and '-' to outcome indexes.
 		# Treat not voting (0 and P) as a null outcome, meaning the Actor didn't
 		# take action for our purposes but should be recorded as not participating.
-		outcome = outcome_index.get(voter.get('vote'))
+		outcome = outcome_index.get(vote_key)
 
 		if outcome is None:
-			if voter.get('vote') == "0":
+			if vote_key == "0":
 				outcome = "Did not vote."
-			elif voter.get('vote') == "P":
+			elif vote_key == "P":
 				outcome = "Voted 'present'."
 			else:
-				raise ValueError("Invalid vote option key: " + str(voter.get('vote')))
+				raise ValueError("Invalid vote option key: " + str(vote_key))
 
 		actor_outcomes[actor] = outcome
 
@@ -203,3 +326,100 @@ def geocode(address):
 	# in case we want to re-parse it later.
 	return (r['StateAbbreviation'] + r['LegislativeInfo']['CongressionalDistrictNumber'], r)
 
+
+class LocalGeocoder(object):
+	"""A stand-in for geocode() that looks up districts by ZIP code in a table, for tests and development."""
+
+	def __init__(self, districts_by_zip=None):
+		import threading
+		self.districts_by_zip = districts_by_zip or { }
+		self.calls = 0
+		self.lock = threading.Lock()
+
+	def __call__(self, address):
+		with self.lock:
+			self.calls += 1
+		return (self.districts_by_zip.get((address[3] or "")[0:5]), { "geocoder": "local" })
+
+def geocode_pledge_executions(pledge_executions, geocoder=None, workers=8, batch_size=100, log=print):
+	# Geocodes the contributor addresses of the PledgeExecutions in the
+	# queryset and sets their districts. Addresses are looked up in the
+	# GeocodedAddress cache first, and the rest are geocoded (by geocode()
+	# unless another geocoder is given) once per distinct address by a
+	# pool of worker threads. The districts and aggregates are updated a
+	# batch at a time. Returns the number of PledgeExecutions updated.
+	#
+	# Only results from geocode() are stored in the GeocodedAddress cache.
+	# Another geocoder's (e.g. a LocalGeocoder's approximate) results are
+	# only remembered for this run, so real geocoding isn't skipped later.
+	import concurrent.futures
+	from django.db import transaction, IntegrityError
+	from contrib.models import PledgeExecution, GeocodedAddress
+
+	persist = (geocoder is None)
+	if geocoder is None:
+		geocoder = geocode
+	run_results = { }
+
+	def get_address(pe):
+		p = pe.pledge
+		return (p.contrib_address, p.contrib_city, p.contrib_state, p.contrib_zip)
+
+	def run_geocoder(item):
+		key, address = item
+		try:
+			district, metadata = geocoder(address)
+		except Exception as e:
+			# Try again next time.
+			log("Geocoder error: %s" % str(e))
+			return key, None
+		if district is None:
+			# Could not geocode. But mark that we tried so we don't
+			# try again.
+			district = "UNKN"
+		return key, (district, metadata)
+
+	def geocode_batch(pool, batch):
+		# Get what we can from the cache.
+		keys = { pe.id: GeocodedAddress.make_key(get_address(pe)) for pe in batch }
+		results = { g.key: (g.district, g.metadata)
+			for g in GeocodedAddress.objects.filter(key__in=set(keys.values())) }
+		results.update({ key: run_results[key] for key in keys.values() if key in run_results })
+
+		# Geocode the rest, each distinct address once.
+		to_geocode = { }
+		for pe in batch:
+			if keys[pe.id] not in results:
+				to_geocode.setdefault(keys[pe.id], get_address(pe))
+		new_entries = []
+		for key, result in pool.map(run_geocoder, to_geocode.items()):
+			if result is None: continue
+			results[key] = result
+			if persist:
+				new_entries.append(GeocodedAddress(key=key, district=result[0], metadata=result[1]))
+			else:
+				run_results[key] = result
+
+		# Add them to the cache.
+		try:
+			with transaction.atomic():
+				GeocodedAddress.objects.bulk_create(new_entries)
+		except IntegrityError:
+			# Another process cached some of the same addresses.
+			for g in new_entries:
+				GeocodedAddress.objects.get_or_create(key=g.key, defaults={ "district": g.district, "metadata": g.metadata })
+
+		# Update the PledgeExecutions.
+		return PledgeExecution.update_districts({
+			pe.id: results[keys[pe.id]]
+			for pe in batch
+			if keys[pe.id] in results })
+
+	# Get the IDs first since we'll be updating the rows as we go.
+	ids = list(pledge_executions.values_list('id', flat=True))
+	updated = 0
+	with concurrent.futures.ThreadPoolExecutor(max(1, workers)) as pool:
+		for i in range(0, len(ids), batch_size):
+			batch = list(PledgeExecution.objects.filter(id__in=ids[i:i+batch_size]).select_related('pledge'))
+			updated += geocode_batch(pool, batch)
+	return updated
@@ -0,0 +1,30 @@
+# Stores card fingerprints on pledges made before they were recorded.
+# ------------------------------------------------------------------
+#
+# Older pledges only have a one-way password hash of the card number,
+# so their fingerprints can only be computed when we're given the card
+# number again. This reads card numbers, one per line, from the given
+# files (or standard input), e.g. from a Democracy Engine export, and
+# fingerprints the pledges each one matches.
+
+from django.core.management.base import BaseCommand, CommandError
+
+import fileinput
+
+from contrib.models import Pledge
+
+class Command(BaseCommand):
+	args = '[file ...]'
+	help = 'Stores card fingerprints on older pledges from a list of card numbers.'
+
+	def handle(self, *args, **options):
+		found = 0
+		for line in fileinput.input(args or ['-']):
+			cc_number = line.strip().replace(' ', '')
+			if not cc_number: continue
+			# find_from_billing stores the fingerprint of each pledge it
+			# finds by its hash.
+			found += len(list(Pledge.find_from_billing(cc_number)))
+
+		remaining = Pledge.objects.filter(cc_fingerprint=None).exclude(cclastfour=None).count()
+		print("%d pledges matched. %d pledges with card numbers still have no fingerprint." % (found, remaining))
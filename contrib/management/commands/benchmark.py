@@ -0,0 +1,290 @@
+# Benchmarks the pledge lifecycle.
+# --------------------------------
+#
+# Creates a throwaway test database, loads the Actor and Recipient
+# fixtures, and for each combination of trigger size (number of
+# actors) and number of pledges runs each stage of a trigger's life
+# against the dummy Democracy Engine API:
+#
+#   create_pledges        authorization test + save for each pledge
+#   execute_trigger       Trigger.execute
+#   pre_execution_emails  the pre-execution emails of send_pledge_emails
+#   de_charges            Democracy Engine charges for a sample of the
+#                         pledges, made one at a time and then concurrently
+#                         with AsyncDemocracyEngineAPI (de_charges_async),
+#                         against a dummy API with simulated latency
+#   execute_pledges       Pledge.execute for each pledge
+#   trigger_page          the trigger view, uncached and then cached
+#
+# and reports the wall time, number of database queries and peak
+# Python memory of each stage as JSON, so that runs on different
+# commits can be compared.
+
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+from optparse import make_option
+
+import os.path, json, time, random, subprocess, tracemalloc
+
+class Command(BaseCommand):
+	args = ''
+	help = 'Benchmarks the pledge lifecycle and writes the results as JSON.'
+
+	option_list = BaseCommand.option_list + (
+		make_option('--actors',
+			dest='actors',
+			default='100,435',
+			help='Comma-separated trigger sizes (number of actors) to benchmark.'),
+		make_option('--pledges',
+			dest='pledges',
+			default='1000',
+			help='Comma-separated numbers of pledges to benchmark.'),
+		make_option('--output',
+			dest='output',
+			default=None,
+			help='Write the results to this file instead of standard output.'),
+		make_option('--seed',
+			type='int',
+			dest='seed',
+			default=0,
+			help='Random seed for the synthetic data.'),
+		make_option('--de-calls',
+			type='int',
+			dest='de_calls',
+			default=200,
+			help='Number of pledges to make sample Democracy Engine charges for.'),
+		make_option('--de-latency',
+			type='float',
+			dest='de_latency',
+			default=0.05,
+			help='Simulated latency in seconds of each sample Democracy Engine charge.'),
+		)
+
+	def handle(self, *args, **options):
+		from django.test.utils import setup_test_environment, teardown_test_environment
+		from django.test.runner import DiscoverRunner
+
+		actor_counts = [int(n) for n in options['actors'].split(',')]
+		pledge_counts = [int(n) for n in options['pledges'].split(',')]
+
+		# Work in a test database with the test environment's settings
+		# (e.g. the in-memory email backend).
+		setup_test_environment()
+		runner = DiscoverRunner(verbosity=0)
+		old_config = runner.setup_databases()
+		try:
+			results = {
+				"commit": self.get_commit(),
+				"runs": [],
+			}
+			for num_actors in actor_counts:
+				for num_pledges in pledge_counts:
+					self.stderr.write("Benchmarking %d actors, %d pledges..." % (num_actors, num_pledges))
+					results["runs"].append(self.run(num_actors, num_pledges, options))
+		finally:
+			runner.teardown_databases(old_config)
+			teardown_test_environment()
+
+		output = json.dumps(results, indent=2, sort_keys=True)
+		if options['output']:
+			with open(options['output'], 'w') as f:
+				f.write(output + "\n")
+		else:
+			print(output)
+
+	def get_commit(self):
+		try:
+			return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL).decode("ascii").strip()
+		except (OSError, subprocess.CalledProcessError):
+			return None
+
+	class QueryCounter(list):
+		# Stands in for connection.queries (a plain list in Django 1.7) to
+		# count the queries that the debug cursor logs without keeping them,
+		# so that a long query log doesn't count toward the peak memory of
+		# a stage.
+		count = 0
+		def append(self, query):
+			self.count += 1
+
+	def measure(self, stages, stage_name, func):
+		# Runs func and records its wall time, query count, and peak memory.
+		from django.db import connection
+		counter = Command.QueryCounter()
+		queries, use_debug_cursor = connection.queries, connection.use_debug_cursor
+		connection.queries, connection.use_debug_cursor = counter, True
+		tracemalloc.start()
+		try:
+			start = time.time()
+			func()
+			elapsed = time.time() - start
+			peak_memory = tracemalloc.get_traced_memory()[1]
+		finally:
+			tracemalloc.stop()
+			connection.queries, connection.use_debug_cursor = queries, use_debug_cursor
+		stages[stage_name] = {
+			"wall_time": elapsed,
+			"queries": counter.count,
+			"peak_memory": peak_memory,
+		}
+
+	def run(self, num_actors, num_pledges, options):
+		from django.core.management import call_command
+		from django.core.cache import cache
+		from django.test import Client
+		from django.utils import timezone
+		import contrib.bizlogic
+		from contrib.bizlogic import run_authorization_test
+		from contrib.models import TriggerType, Trigger, TriggerStatus, TextFormat, Actor, Pledge, ActorParty
+		from contrib.execution import PledgeExecutionEngine
+		from itfsite.models import User
+
+		rand = random.Random(options['seed'])
+
+		# Start from an empty database and cache and use the dummy DE API.
+		call_command('flush', interactive=False, verbosity=0)
+		cache.clear()
+		contrib.bizlogic.DemocracyEngineAPI = contrib.bizlogic.DummyDemocracyEngineAPI()
+		Pledge.ENFORCE_EXECUTION_EMAIL_DELAY = False
+		fixtures_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))), 'fixtures')
+		call_command('loaddata', os.path.join(fixtures_dir, 'actor.yaml'), os.path.join(fixtures_dir, 'recipient.yaml'), verbosity=0)
+		actors = list(Actor.objects.order_by('id')[0:num_actors])
+		if len(actors) < num_actors:
+			raise CommandError("The fixtures only have %d actors." % len(actors))
+
+		# Make a synthetic trigger.
+		tt = TriggerType.objects.create(
+			key="benchmark",
+			strings={
+				"actor": "ACTOR",
+				"actors": "ACTORS",
+				"action_noun": "ACTION",
+				"action_vb_inf": "ACT",
+				"action_vb_pres_s": "ACTS",
+				"action_vb_past": "ACTED",
+			})
+		trigger = Trigger.objects.create(
+			key="benchmark",
+			title="Benchmark Trigger",
+			trigger_type=tt,
+			slug="benchmark-trigger",
+			description="This is a benchmark trigger.",
+			description_format=TextFormat.Markdown,
+			outcomes=[{ "label": "Yes" }, { "label": "No" }],
+			extra={ "max_split": num_actors },
+			status=TriggerStatus.Open,
+			)
+		User.objects.bulk_create([User(email="benchmark%d@example.com" % i) for i in range(num_pledges)])
+		users = list(User.objects.filter(email__startswith="benchmark").order_by('id'))
+
+		stages = { }
+
+		def create_pledges():
+			for user in users:
+				p = Pledge(
+					user=user,
+					trigger=trigger,
+					algorithm=Pledge.current_algorithm()['id'],
+					desired_outcome=rand.choice((0, 1)),
+					amount=rand.choice((5, 10, 25, 100)),
+					incumb_challgr=rand.choice((-1, 0, 1)),
+					filter_party=rand.choice((None, ActorParty.Democratic, ActorParty.Republican)),
+					contrib_name_first='FIRST',
+					contrib_name_last='LAST',
+					contrib_address='ADDRESS',
+					contrib_city='CITY',
+					contrib_state='NY',
+					contrib_zip='00000',
+					contrib_occupation='OCCUPATION',
+					contrib_employer='EMPLOYER',
+					extra={ },
+					)
+				run_authorization_test(p, "4111111111111111", 9, 2025, '999', { "benchmark": True })
+				p.save()
+		self.measure(stages, "create_pledges", create_pledges)
+
+		def execute_trigger():
+			actor_outcomes = { actor: rand.choice((0, 0, 1, 1, None)) for actor in actors }
+			trigger.execute(timezone.now(), actor_outcomes, "Benchmark.", TextFormat.Markdown, { })
+		self.measure(stages, "execute_trigger", execute_trigger)
+
+		def pre_execution_emails():
+			from contrib.management.commands.send_pledge_emails import Command as SendPledgeEmailsCommand
+			cmd = SendPledgeEmailsCommand()
+			cmd.BATCH_SIZE = 250
+			cmd.send_pledge_emails('pre')
+		try:
+			self.measure(stages, "pre_execution_emails", pre_execution_emails)
+		except ImportError as e:
+			# htmlemailer isn't installed. Mark the emails as sent so the
+			# pledges can be executed.
+			stages["pre_execution_emails"] = { "error": str(e) }
+			Pledge.objects.filter(trigger=trigger).update(pre_execution_email_sent_at=timezone.now())
+
+		self.measure_de_charges(stages, trigger, options['de_calls'], options['de_latency'])
+
+		def execute_pledges():
+			engine = PledgeExecutionEngine(log=lambda msg : None)
+			summary = engine.run(Pledge.objects.filter(trigger=trigger).order_by('id').values_list('id', flat=True))
+			stages["execute_pledges_summary"] = summary.as_dict()
+		self.measure(stages, "execute_pledges", execute_pledges)
+
+		client = Client()
+		url = Trigger.objects.get(id=trigger.id).get_absolute_url()
+		self.measure(stages, "trigger_page", lambda : client.get(url))
+		self.measure(stages, "trigger_page_cached", lambda : client.get(url))
+
+		return {
+			"actors": num_actors,
+			"pledges": num_pledges,
+			"stages": stages,
+		}
+
+	def measure_de_charges(self, stages, trigger, num_calls, latency):
+		# Compare making the Democracy Engine charges for a sample of the
+		# pledges one at a time with making them concurrently through
+		# AsyncDemocracyEngineAPI. Nothing is recorded in the database.
+		import asyncio
+		import contrib.bizlogic
+		from contrib.bizlogic import get_pledge_recipients, build_pledge_donation, RecipientPlans, \
+			HumanReadableValidationError, AsyncDemocracyEngineAPI, DummyDemocracyEngineAPI, coroutine
+		from contrib.models import Pledge
+
+		donation_requests = []
+		recipient_plans = RecipientPlans()
+		for p in Pledge.objects.filter(trigger=trigger).select_related('user', 'trigger', 'trigger__execution', 'billing_profile').order_by('id')[0:num_calls]:
+			recipients = get_pledge_recipients(p.trigger, p, recipient_plans)
+			if len(recipients) == 0:
+				continue
+			try:
+				donation_requests.append(build_pledge_donation(p, recipients)[3])
+			except HumanReadableValidationError:
+				continue
+
+		contrib.bizlogic.DemocracyEngineAPI = DummyDemocracyEngineAPI(latency=latency)
+		try:
+			def charge():
+				for req in donation_requests:
+					contrib.bizlogic.DemocracyEngineAPI.create_donation(req)
+			self.measure(stages, "de_charges", charge)
+
+			def charge_async():
+				api = AsyncDemocracyEngineAPI()
+				@coroutine
+				def submit_all():
+					return (yield from asyncio.gather(*[api.create_donation(req) for req in donation_requests]))
+				loop = asyncio.new_event_loop()
+				asyncio.set_event_loop(loop)
+				try:
+					loop.run_until_complete(submit_all())
+				finally:
+					asyncio.set_event_loop(None)
+					loop.close()
+					api.close()
+			self.measure(stages, "de_charges_async", charge_async)
+		finally:
+			contrib.bizlogic.DemocracyEngineAPI = DummyDemocracyEngineAPI()
+
+		for stage_name in ("de_charges", "de_charges_async"):
+			stages[stage_name]["calls"] = len(donation_requests)
+			stages[stage_name]["latency"] = latency
@@ -5,18 +5,27 @@
 # -----------------------------------------------------
 #
 # See https://github.com/unitedstates/congress-legislators.
+#
+# The sync is incremental: the existing Actors and Recipients are
+# loaded up front, each Actor is compared with the new data by a hash of
+# its field values, and only new and changed rows are written.
 
 from django.core.management.base import BaseCommand, CommandError
 from django.db import transaction
 from django.conf import settings
 from django.contrib.humanize.templatetags.humanize import ordinal
+from django.core.serializers.json import DjangoJSONEncoder
+from optparse import make_option
 
+import json, hashlib
 import requests
 import rtyaml
 
 from contrib.models import Actor, ActorParty, Recipient
 from contrib.bizlogic import DemocracyEngineAPI
 
+LEGISLATORS_CURRENT_URL = "https://raw.githubusercontent.com/unitedstates/congress-legislators/master/legislators-current.yaml"
+
 party_map = {
 	'Democrat': ActorParty.Democratic,
 	'Republican': ActorParty.Republican,
@@ -28,23 +37,71 @@ class Command(BaseCommand):
 	args = ''
 	help = 'Creates/updates Actor and Recipient instances.'
 
+	option_list = BaseCommand.option_list + (
+		make_option('--legislators',
+			dest='legislators',
+			default=None,
+			help='Read legislators-current.yaml from this file instead of downloading it.'),
+		make_option('--recipients',
+			dest='recipients',
+			default=None,
+			help='Read the Democracy Engine recipients from this file (the output of dump_de_recipients) instead of querying the API.'),
+		)
+
 	@transaction.atomic
 	def handle(self, *args, **options):
+		self.changes = {
+			"actors_added": 0,
+			"actors_updated": 0,
+			"actors_unchanged": 0,
+			"recipients_added": 0,
+			"recipients_activated": 0,
+			"recipients_deactivated": 0,
+			"challengers_associated": 0,
+			"recipients_missing": 0,
+		}
+
 		# Load and parse current Members of Congress YAML.
-		r = requests.get("https://raw.githubusercontent.com/unitedstates/congress-legislators/master/legislators-current.yaml")
-		r = rtyaml.load(r.content)
+		if options.get('legislators'):
+			with open(options['legislators'], 'rb') as f:
+				legislators = rtyaml.load(f.read())
+		else:
+			r = requests.get(LEGISLATORS_CURRENT_URL)
+			r.raise_for_status()
+			legislators = rtyaml.load(r.content)
 
 		# Pre-load all of the Democracy Engine recipients and build a map.
-		de_recips = DemocracyEngineAPI.recipients()
+		if options.get('recipients'):
+			with open(options['recipients'], 'rb') as f:
+				de_recips = rtyaml.load(f.read())
+		else:
+			de_recips = DemocracyEngineAPI.recipients()
 		de_recips = { r['recipient_id']: r for r in de_recips }
 
-		# Create Actor instances.
-		for p in r:
+		# Load the existing Actors and Recipients.
+		actors = { a.govtrack_id: a for a in Actor.objects.all() }
+		recipients = list(Recipient.objects.all())
+
+		actors = self.sync_actors(legislators, actors)
+		self.sync_recipients(legislators, actors, recipients, de_recips)
+
+		# Report.
+		self.stdout.write(", ".join("%s: %d" % (k.replace("_", " "), v) for k, v in sorted(self.changes.items())))
+
+	def sync_actors(self, legislators, actors):
+		# Creates and updates Actors and returns a new dict of all Actors
+		# by GovTrack ID.
+		new_actors = []
+		for p in legislators:
 			# The last term is the Member of Congress's current term.
 			term = p['terms'][-1]
 			del p['terms']
 			p['term'] = term
 
+			# Store the data the way the JSONField will return it, so
+			# that it compares equal to what's in the database.
+			p = json.loads(json.dumps(p, cls=DjangoJSONEncoder))
+
 			# Group independents with the party they caucus with. Try the
 			# 'caucus' field first, and if it's not set (which is typical)
 			# then use the party field. After that there should be no
@@ -60,48 +117,71 @@ class Command(BaseCommand):
 				'title': build_title(p, term),
 			}
 
-			# Create or update.
-			actor, is_new = Actor.objects.get_or_create(
-				govtrack_id = p["id"]["govtrack"],
-				defaults = fields,
-				)
-
-			if not is_new:
-				# Update. These are required fields so we
-				# had to specify them in get_or_create.
-				# Now report what's changed.
-				for k, v in fields.items():
-					if getattr(actor, k) != v:
-						self.stdout.write('%s\t%s=>%s' % (actor.name_long, getattr(actor, k), v))
-					setattr(actor, k, v)
-
-			# Store the full API response from GovTrack in the Actor instance.
-			if actor.extra in (None, ''): actor.extra = { }
-			actor.extra['legislators-current'] = p
-			actor.save()
-
-			if is_new:
-				self.stdout.write('Added: ' + actor.name_long)
+			actor = actors.get(p["id"]["govtrack"])
+			if actor is None:
+				# Create, along with the other new Actors below.
+				fields['extra'] = { 'legislators-current': p }
+				new_actors.append(Actor(govtrack_id=p["id"]["govtrack"], **fields))
+				self.stdout.write('Added: ' + fields['name_long'])
+				self.changes["actors_added"] += 1
+				continue
+
+			# Store the full API response from GovTrack in the Actor instance,
+			# keeping any other extra data.
+			extra = dict(actor.extra or { })
+			extra['legislators-current'] = p
+			fields['extra'] = extra
+
+			# Skip Actors whose data hasn't changed.
+			if content_hash({ k: getattr(actor, k) for k in fields }) == content_hash(fields):
+				self.changes["actors_unchanged"] += 1
+				continue
+
+			# Report what's changed.
+			for k, v in fields.items():
+				if k != 'extra' and getattr(actor, k) != v:
+					self.stdout.write('%s\t%s=>%s' % (actor.name_long, getattr(actor, k), v))
+				setattr(actor, k, v)
+			Actor.objects.filter(id=actor.id).update(**fields)
+			self.changes["actors_updated"] += 1
+
+		if new_actors:
+			# bulk_create doesn't set the primary keys, so reload.
+			Actor.objects.bulk_create(new_actors)
+			actors = { a.govtrack_id: a for a in Actor.objects.all() }
+
+		return actors
+
+	def sync_recipients(self, legislators, actors, recipients, de_recips):
+		# Creates Recipients for the Actors and their challengers, associates
+		# challengers with Actors, and updates the active flags.
+		incumbents = { r.actor_id: r for r in recipients if r.actor_id is not None }
+		challengers = { (r.office_sought, r.party): r for r in recipients if r.actor_id is None }
+
+		# Make a list of the Recipients to create and of the challengers
+		# that need to be associated with Actors.
+		new_recipients = []
+		new_challengers = { } # Actor => (office_sought, party)
+		synced_actors = []
+		for p in legislators:
+			actor = actors[p["id"]["govtrack"]]
 
 			# Create a Recipient for this Actor.
 			de_id = "p_%d" % actor.govtrack_id
 			if de_id not in de_recips:
 				self.stdout.write('Missing recipient %s for %s!' % (de_id, actor.name_long))
+				self.changes["recipients_missing"] += 1
 				continue
-			else:
-				recipient, is_new = Recipient.objects.get_or_create(
-					actor=actor,
-					office_sought=None,
-					party=None,
-					defaults={ "de_id": de_id }
-					)
-				if is_new:
-					self.stdout.write('Added recipient for: %s (%s)' % (actor.name_long, de_recips[de_id]['name']))
-				self.update_recipient_active(recipient, de_recips)
+			synced_actors.append(actor)
+			recipient = incumbents.get(actor.id)
+			if recipient is None:
+				recipient = Recipient(actor=actor, de_id=de_id, active=is_active(de_id, de_recips))
+				new_recipients.append(recipient)
+				self.stdout.write('Added recipient for: %s (%s)' % (actor.name_long, de_recips[de_id]['name']))
 
 			# Create a challenger for the Actor if one is not yet set
 			# and the Actor has an active recipient itself.
-			if actor.challenger is None and recipient.active:
+			if actor.challenger_id is None and is_active(recipient.de_id, de_recips):
 				# Get the office based on the Actor's current term and opposing party.
 				term = actor.extra['legislators-current']['term']
 				if term['type'] == 'rep':
@@ -116,28 +196,56 @@ class Command(BaseCommand):
 				de_id = "c_" + "-".join(office + [party.name[0]])
 				if de_id not in de_recips:
 					self.stdout.write('Missing challenger recipient %s!' % de_id)
+					self.changes["recipients_missing"] += 1
 				else:
-					recipient, is_new = Recipient.objects.get_or_create(
-						actor=None,
-						office_sought="-".join(office),
-						party=party,
-						defaults={ "de_id": de_id }
-						)
-					actor.challenger = recipient
-					actor.save()
+					key = ("-".join(office), party)
+					if key not in challengers:
+						challengers[key] = Recipient(actor=None, office_sought=key[0], party=party, de_id=de_id, active=is_active(de_id, de_recips))
+						new_recipients.append(challengers[key])
+					new_challengers[actor] = key
 					self.stdout.write('%s challenger recipient for %s (%s).' %
-						("Created" if is_new else "Associated", actor.name_long, de_id))
-
-			# Update the 'active' field on the challenger.
-			if actor.challenger:
-				self.update_recipient_active(actor.challenger, de_recips)
-
-	def update_recipient_active(self, recipient, de_recips):
-		active = (de_recips[recipient.de_id]['status'] == 'active')
-		if recipient.active != active:
-			self.stdout.write('Setting recipient %s active to %s.' % (recipient, str(active)))
-			recipient.active = active
-			recipient.save()
+						("Created" if challengers[key].id is None else "Associated", actor.name_long, de_id))
+
+		# Create the new Recipients. bulk_create doesn't set the primary
+		# keys, so reload them.
+		if new_recipients:
+			Recipient.objects.bulk_create(new_recipients)
+			self.changes["recipients_added"] += len(new_recipients)
+			recipients = list(Recipient.objects.all())
+			challengers = { (r.office_sought, r.party): r for r in recipients if r.actor_id is None }
+
+		# Associate the challengers.
+		for actor, key in new_challengers.items():
+			actor.challenger = challengers[key]
+			Actor.objects.filter(id=actor.id).update(challenger=actor.challenger)
+			self.changes["challengers_associated"] += 1
+
+		# Update the 'active' field on the Actors' recipients and their
+		# challengers, in one query for each direction.
+		recipients_by_id = { r.id: r for r in recipients }
+		incumbents = { r.actor_id: r for r in recipients if r.actor_id is not None }
+		updates = { True: [], False: [] }
+		for actor in synced_actors:
+			for recipient in (incumbents[actor.id], recipients_by_id.get(actor.challenger_id)):
+				if recipient is None or recipient.de_id not in de_recips: continue
+				active = is_active(recipient.de_id, de_recips)
+				if recipient.active != active:
+					self.stdout.write('Setting recipient %s active to %s.' % (recipient, str(active)))
+					updates[active].append(recipient.id)
+		for active, ids in updates.items():
+			if ids:
+				Recipient.objects.filter(id__in=ids).update(active=active)
+		self.changes["recipients_activated"] += len(updates[True])
+		self.changes["recipients_deactivated"] += len(updates[False])
+
+def is_active(de_id, de_recips):
+	return de_recips[de_id]['status'] == 'active'
+
+def content_hash(fields):
+	# A hash of an Actor's field values, for detecting changes.
+	fields = dict(fields)
+	fields['party'] = fields['party'].name
+	return hashlib.sha1(json.dumps(fields, sort_keys=True, cls=DjangoJSONEncoder).encode("utf8")).hexdigest()
 
 def build_name(p, t, mode):
 	# Based on:
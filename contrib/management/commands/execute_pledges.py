@@ -3,30 +3,74 @@
 
 from django.core.management.base import BaseCommand, CommandError
 from django.conf import settings
+from optparse import make_option
 
-from contrib.models import TriggerStatus, Pledge, PledgeStatus
-from contrib.legislative import execute_trigger_from_vote
+from django.db.models import F
+
+from contrib.models import Trigger, TriggerStatus, TriggerExecution, Pledge, PledgeStatus
+from contrib.bizlogic import DemocracyEngineAPI
+from contrib.execution import PledgeExecutionEngine
+from contrib.reports import get_trigger_execution_report_file
 
 import tqdm
 
 class Command(BaseCommand):
-	args = ''
+	args = '[trigger_id]'
 	help = 'Executes any open pledges on executed triggers.'
 
+	option_list = BaseCommand.option_list + (
+		make_option('--workers',
+			type='int',
+			dest='workers',
+			default=1,
+			help='Number of pledges to execute concurrently.'),
+		make_option('--processes',
+			action='store_true',
+			dest='processes',
+			default=False,
+			help='Use worker processes instead of worker threads.'),
+		make_option('--checkpoint',
+			dest='checkpoint',
+			default=None,
+			help='A file to record progress in so that a crashed run can be resumed.'),
+		make_option('--retry-in-flight',
+			action='store_true',
+			dest='retry_in_flight',
+			default=False,
+			help='Re-execute pledges that a crashed run was in the middle of executing or that failed with an error.'),
+		)
+
 	def handle(self, *args, **options):
 		# Open pledges on executed triggers can be executed.
 		pledges_to_execute = Pledge.objects.filter(status=PledgeStatus.Open, trigger__status=TriggerStatus.Executed)
+		if len(args) > 0:
+			pledges_to_execute = pledges_to_execute.filter(trigger__id=args[0])
+		pledge_ids = list(pledges_to_execute.order_by('id').values_list('id', flat=True))
+		trigger_ids = set(pledges_to_execute.values_list('trigger_id', flat=True))
+
+		engine = PledgeExecutionEngine(
+			workers=options.get('workers') or 1,
+			processes=options.get('processes', False),
+			checkpoint=options.get('checkpoint'),
+			retry_in_flight=options.get('retry_in_flight', False),
+			)
+
+		# Execute them.
+		summary = engine.run(pledge_ids,
+			progress=lambda results, total : tqdm.tqdm(results, total=total))
+		print(summary)
+
+		# Report the Democracy Engine calls made from this process. (Calls
+		# made in worker processes aren't seen here.)
+		for method, st in sorted(DemocracyEngineAPI.get_stats().items()):
+			print("Democracy Engine {method}: {count} calls, {errors} failed. Latency mean {mean_time:.3f}s, max {max_time:.3f}s.".format(method=method, **st))
 
-		# Loop through them.
-		for p in tqdm.tqdm(pledges_to_execute):
-			# Execute the pledge.
-			try:
-				p.execute()
-
-			# ValueError indicates a known condition that makes the pledge
-			# non-executable. We should skip it. Sometimes it just means
-			# we have to wait.
-			except ValueError as e:
-				print(p)
-				print(e)
-				print()
+		# Make sure the triggers' pledge counts are exact (pledges may
+		# have been cancelled) and then compute and cache the trigger page
+		# statistics and report for triggers that are now done executing.
+		for trigger_id in trigger_ids:
+			Trigger.rollup_pledge_counts(trigger_id)
+		for te in TriggerExecution.objects.filter(trigger__id__in=trigger_ids, pledge_count=F('trigger__pledge_count')).select_related('trigger'):
+			te.get_summary()
+			if te.pledge_count_with_contribs > 0:
+				get_trigger_execution_report_file(te)
@@ -3,19 +3,50 @@
 
 from django.core.management.base import BaseCommand, CommandError
 from django.conf import settings
+from optparse import make_option
 
 from contrib.models import Trigger
-from contrib.legislative import execute_trigger_from_vote
+from contrib.legislative import execute_trigger_from_vote, GovTrackVoteSource, FileVoteSource
 
 class Command(BaseCommand):
-	args = 'trigger_id vote_url'
-	help = 'Executes a trigger (by ID) using the URL to a GovTrack vote page.'
+	args = 'trigger_id [vote_url]'
+	help = 'Executes a trigger (by ID) using the URL to a GovTrack vote page, or a saved copy of the vote.'
+
+	option_list = BaseCommand.option_list + (
+		make_option('--json',
+			dest='json',
+			default=None,
+			help='Read the vote metadata from this file (saved from the vote URL + ".json") instead of GovTrack.'),
+		make_option('--xml',
+			dest='xml',
+			default=None,
+			help='Read the voters from this file (saved from the vote URL + "/export/xml") instead of GovTrack.'),
+		make_option('--no-cache',
+			action='store_true',
+			dest='no_cache',
+			default=False,
+			help='Fetch the vote from GovTrack even if it is cached.'),
+		)
 
 	def handle(self, *args, **options):
-		if len(args) < 2:
+		from_file = options.get('json') or options.get('xml')
+		if len(args) < (1 if from_file else 2) or (from_file and not (options.get('json') and options.get('xml'))):
 			print("Usage: ./manage.my execute_trigger trigger_id vote_url")
+			print("   or: ./manage.my execute_trigger --json vote.json --xml vote.xml trigger_id [vote_url]")
 			return
 			
 		t = Trigger.objects.get(id=args[0])
-		url = args[1]
-		execute_trigger_from_vote(t, url)
+		url = args[1] if len(args) > 1 else None
+
+		if from_file:
+			source = FileVoteSource(options['json'], options['xml'])
+		elif options.get('no_cache'):
+			# Fetch into a fresh directory that is removed when we're done.
+			import tempfile
+			with tempfile.TemporaryDirectory() as cache_dir:
+				execute_trigger_from_vote(t, url, source=GovTrackVoteSource(url, cache_dir=cache_dir))
+			return
+		else:
+			source = GovTrackVoteSource(url)
+
+		execute_trigger_from_vote(t, url, source=source)
@@ -3,29 +3,46 @@
 
 from django.core.management.base import BaseCommand, CommandError
 from django.conf import settings
+from optparse import make_option
 
 from contrib.models import PledgeExecution, PledgeExecutionProblem
-from contrib.via_govtrack import geocode
+from contrib.legislative import geocode_pledge_executions, LocalGeocoder
 
 class Command(BaseCommand):
 	args = ''
 	help = 'Geocodes executed pledges.'
 
+	option_list = BaseCommand.option_list + (
+		make_option('--workers',
+			type='int',
+			dest='workers',
+			default=8,
+			help='Number of addresses to geocode concurrently.'),
+		make_option('--batch-size',
+			type='int',
+			dest='batch_size',
+			default=100,
+			help='Number of pledges to update the district aggregates for at once.'),
+		make_option('--local',
+			dest='local',
+			default=None,
+			help='Instead of calling the geocoding API, look up districts by ZIP code in this JSON file. These results are not cached.'),
+		)
+
 	def handle(self, *args, **options):
 		pledgexecs = PledgeExecution.objects.filter(
 			problem=PledgeExecutionProblem.NoProblem,
 			district=None,
-			).select_related("pledge")
+			).order_by('id')
+
+		geocoder = None
+		if options.get('local'):
+			import json
+			with open(options['local']) as f:
+				geocoder = LocalGeocoder(json.load(f))
 
-		for pe in pledgexecs:
-			district, metadata = geocode([
-				pe.pledge.extra['contribAddress'],
-				pe.pledge.extra['contribCity'],
-				pe.pledge.extra['contribState'],
-				pe.pledge.extra['contribZip']])
-			if district == None:
-				# Could not geocode. But mark that we tried so we don't
-				# try again.
-				district = "UNKN"
-			pe.update_district(district, metadata)
-			print(district, pe)
+		count = geocode_pledge_executions(pledgexecs,
+			geocoder=geocoder,
+			workers=options.get('workers') or 8,
+			batch_size=options.get('batch_size') or 100)
+		print("Geocoded %d pledges." % count)
@@ -0,0 +1,17 @@
+# Fetches the Democracy Engine subscriber meta info.
+# --------------------------------------------------
+#
+# Stores it in the Django cache, where web processes pick it up, so
+# that no web process or user request has to wait on Democracy Engine
+# for it.
+
+from django.core.management.base import BaseCommand, CommandError
+
+from contrib.bizlogic import DemocracyEngineAPI
+
+class Command(BaseCommand):
+	args = ''
+	help = 'Fetches the Democracy Engine subscriber meta info into the cache.'
+
+	def handle(self, *args, **options):
+		DemocracyEngineAPI.refresh_meta_info()
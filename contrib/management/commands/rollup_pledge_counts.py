@@ -0,0 +1,26 @@
+# Rolls up the pledge counters of triggers.
+# -----------------------------------------
+#
+# Run by bin/cron-frequent. Pledges only increment their trigger's
+# counters, so this is what updates the pledge counts shown on the
+# site. Triggers that are being executed are included because a
+# trigger is done executing when its pledge count matches its
+# execution's.
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import F
+
+from contrib.models import Trigger, TriggerStatus
+
+class Command(BaseCommand):
+	args = '[trigger_id ...]'
+	help = 'Updates the cached pledge counts of triggers from their pledge counters.'
+
+	def handle(self, *args, **options):
+		if args:
+			trigger_ids = [int(arg) for arg in args]
+		else:
+			trigger_ids = list(Trigger.objects.filter(status__in=(TriggerStatus.Open, TriggerStatus.Paused)).values_list('id', flat=True))
+			trigger_ids += list(Trigger.objects.filter(status=TriggerStatus.Executed).exclude(execution__pledge_count=F('pledge_count')).values_list('id', flat=True))
+		for trigger_id in trigger_ids:
+			Trigger.rollup_pledge_counts(trigger_id)
@@ -6,7 +6,7 @@ from django.conf import settings
 from django.utils import timezone
 
 from contrib.models import Pledge, TriggerStatus, PledgeStatus
-from contrib.bizlogic import get_pledge_recipients, compute_charge
+from contrib.bizlogic import get_pledge_recipients, compute_charge, RecipientPlans
 
 from htmlemailer import send_mail
 
@@ -50,29 +50,81 @@ class Command(BaseCommand):
 		else:
 			raise ValueError()
 
-		# Send email for each.
+		# Send email for each. For the pre/post emails, load the TriggerExecution
+		# too so that the recipients for each pledge come from the trigger's
+		# RecipientPlan without any further queries.
 		pledges = pledges.select_related("user")
-		for pledge in pledges:
+		if pre_or_post in ("pre", "post"):
+			pledges = pledges.select_related("user", "trigger", "trigger__execution")
+
+		if pre_or_post == "emailconfirm":
+			for pledge in pledges:
+				if pledge.should_retry_email_confirmation():
+					pledge.send_email_confirmation(first_try=False)
+			return
+
+		# Send the pre/post emails in batches, recording which were sent
+		# at the end of each batch.
+		self.charges = { }
+		self.recipient_plans = RecipientPlans()
+		batch = []
+		for pledge in pledges.iterator():
 			# Apply a post-db-query filter.
 			if not pledge_filter(pledge):
 				continue
+			batch.append(pledge)
+			if len(batch) == self.BATCH_SIZE:
+				self.send_batch(pre_or_post, batch)
+				batch = []
+		if batch:
+			self.send_batch(pre_or_post, batch)
 
-			# Call the appropriate send function.
-			if pre_or_post in ("pre", "post"):
-				self.send_pledge_email(pre_or_post, pledge)
+	BATCH_SIZE = 250
 
-			elif pre_or_post == "emailconfirm":
-				if pledge.should_retry_email_confirmation():
-					pledge.send_email_confirmation(first_try=False)
-	
-	def send_pledge_email(self, pre_or_post, pledge):
-		# What will happen when the pledge is executed?
-		recipients = get_pledge_recipients(pledge.trigger, pledge)
-		if len(recipients) == 0:
-			# This pledge will result in nothing happening. There is
-			# no need to email.
-			return
-		recip_contribs, fees, total_charge = compute_charge(pledge, recipients)
+	def send_batch(self, pre_or_post, pledges):
+		import time
+		from django.core.mail import get_connection
+		start = time.time()
+
+		# Each batch is sent over its own SMTP connection. Mail relays
+		# may limit the number of messages sent over one connection or
+		# drop it when it's idle.
+		connection = get_connection()
+
+		# Record which were sent even if sending fails partway through
+		# the batch, so that no one gets the same email twice.
+		sent = []
+		try:
+			connection.open()
+			for pledge in pledges:
+				if self.send_pledge_email(pre_or_post, pledge, connection):
+					sent.append(pledge.id)
+		finally:
+			field_name = "%s_execution_email_sent_at" % pre_or_post
+			Pledge.objects.filter(id__in=sent).update(**{ field_name: timezone.now() })
+			connection.close()
+
+		elapsed = time.time() - start
+		print("%s-execution emails: sent %d of %d pledges in %.1fs (%.1f/s)." % (
+			pre_or_post, len(sent), len(pledges), elapsed, len(sent) / elapsed if elapsed > 0 else 0))
+
+	def send_pledge_email(self, pre_or_post, pledge, connection):
+		# What will happen when the pledge is executed? Every pledge on the
+		# same trigger with the same filters and amount has the same charge,
+		# so compute it once for each combination.
+		key = (pledge.trigger_id, pledge.desired_outcome, pledge.incumb_challgr, pledge.filter_party, pledge.amount)
+		if key not in self.charges:
+			recipients = get_pledge_recipients(pledge.trigger, pledge, self.recipient_plans)
+			if len(recipients) == 0:
+				# This pledge will result in nothing happening. There is
+				# no need to email.
+				self.charges[key] = None
+			else:
+				recip_contribs, fees, total_charge = compute_charge(pledge, recipients)
+				self.charges[key] = total_charge
+		total_charge = self.charges[key]
+		if total_charge is None:
+			return False
 
 		# Send email.
 		send_mail(
@@ -83,9 +135,6 @@ class Command(BaseCommand):
 				"pledge": pledge,
 				"until": Pledge.current_algorithm()['pre_execution_warn_time'][1],
 				"total_charge": total_charge,
-			})
-
-		# Record that it was sent.
-		field_name = "%s_execution_email_sent_at" % pre_or_post
-		setattr(pledge, field_name, timezone.now())
-		pledge.save(update_fields=[field_name])
+			},
+			connection=connection)
+		return True
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contrib', '0005_incompletepledge'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pledge',
+            name='cc_fingerprint',
+            field=models.CharField(help_text="A keyed hash (HMAC) of the user's credit card number, stored & indexed for exact look-up of a pledge from a credit card number.", blank=True, db_index=True, null=True, max_length=64),
+            preserve_default=True,
+        ),
+    ]
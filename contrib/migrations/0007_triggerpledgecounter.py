@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+def create_counters(apps, schema_editor):
+    # Start each trigger's counters off with its current totals.
+    Trigger = apps.get_model("contrib", "Trigger")
+    TriggerPledgeCounter = apps.get_model("contrib", "TriggerPledgeCounter")
+    TriggerPledgeCounter.objects.bulk_create([
+        TriggerPledgeCounter(trigger_id=t.id, stripe=0, pledge_count=t.pledge_count, total_pledged=t.total_pledged)
+        for t in Trigger.objects.all()
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contrib', '0006_pledge_cc_fingerprint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TriggerPledgeCounter',
+            fields=[
+                ('id', models.AutoField(auto_created=True, verbose_name='ID', primary_key=True, serialize=False)),
+                ('stripe', models.IntegerField(help_text="Which of the Trigger's counters this is.")),
+                ('pledge_count', models.IntegerField(default=0, help_text="This stripe's part of the number of pledges made.")),
+                ('total_pledged', models.DecimalField(max_digits=6, decimal_places=2, default=0, help_text="This stripe's part of the total amount of pledges.")),
+                ('trigger', models.ForeignKey(related_name='pledge_counters', to='contrib.Trigger', help_text='The Trigger that this counter is for.')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='triggerpledgecounter',
+            unique_together=set([('trigger', 'stripe')]),
+        ),
+        migrations.RunPython(create_counters),
+    ]
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import django.db.models.deletion
+import contrib.models
+
+
+CONTRIBUTOR_FIELDS = (
+    ('contribNameFirst', 'contrib_name_first'),
+    ('contribNameLast', 'contrib_name_last'),
+    ('contribAddress', 'contrib_address'),
+    ('contribCity', 'contrib_city'),
+    ('contribState', 'contrib_state'),
+    ('contribZip', 'contrib_zip'),
+    ('contribOccupation', 'contrib_occupation'),
+    ('contribEmployer', 'contrib_employer'),
+)
+
+
+def move_extra_to_columns(apps, schema_editor):
+    # Move the contributor fields into their columns and the billing info into
+    # BillingProfiles, one per credit card token. Pledges that re-used billing
+    # info from another pledge have the same token and share its profile.
+    # Billing info without a token can't be a BillingProfile, so it is left
+    # in extra.
+    Pledge = apps.get_model("contrib", "Pledge")
+    BillingProfile = apps.get_model("contrib", "BillingProfile")
+    profiles = { }
+    for p in Pledge.objects.all().order_by('id'):
+        contributor = p.extra.pop('contributor', {})
+        for field, column in CONTRIBUTOR_FIELDS:
+            setattr(p, column, contributor.get(field, ''))
+
+        billing = p.extra.get('billing')
+        if billing and billing.get('de_cc_token'):
+            del p.extra['billing']
+            token = billing['de_cc_token']
+            if token not in profiles:
+                profiles[token] = BillingProfile.objects.create(
+                    cc_num_hashed=billing['cc_num_hashed'],
+                    cc_exp_month=billing['cc_exp_month'],
+                    cc_exp_year=billing['cc_exp_year'],
+                    de_cc_token=token,
+                    authorization=billing.get('authorization', {}))
+            p.billing_profile = profiles[token]
+            if 'via_pledge' in billing:
+                p.extra['billing_via_pledge'] = billing['via_pledge']
+
+        p.save()
+
+
+def move_columns_to_extra(apps, schema_editor):
+    Pledge = apps.get_model("contrib", "Pledge")
+    for p in Pledge.objects.all().select_related('billing_profile'):
+        p.extra['contributor'] = { field: getattr(p, column) for field, column in CONTRIBUTOR_FIELDS }
+        if p.billing_profile:
+            b = p.billing_profile
+            p.extra['billing'] = {
+                'cc_num_hashed': b.cc_num_hashed,
+                'cc_exp_month': b.cc_exp_month,
+                'cc_exp_year': b.cc_exp_year,
+                'de_cc_token': b.de_cc_token,
+                'authorization': b.authorization,
+            }
+            if 'billing_via_pledge' in p.extra:
+                p.extra['billing']['via_pledge'] = p.extra.pop('billing_via_pledge')
+        p.save()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contrib', '0007_triggerpledgecounter'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BillingProfile',
+            fields=[
+                ('id', models.AutoField(auto_created=True, verbose_name='ID', primary_key=True, serialize=False)),
+                ('created', models.DateTimeField(db_index=True, auto_now_add=True)),
+                ('cc_num_hashed', models.CharField(max_length=128, help_text='A password hash of the credit card number, for verifying a look-up of pledges by card number.')),
+                ('cc_exp_month', models.IntegerField(help_text="The card's expiration month, so we know if it has expired before using the token.")),
+                ('cc_exp_year', models.IntegerField(help_text="The card's expiration year.")),
+                ('de_cc_token', models.CharField(unique=True, max_length=128, help_text='The Democracy Engine credit card token for making charges.')),
+                ('authorization', contrib.models.JSONField(blank=True, help_text='The Democracy Engine response to the authorization test.')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AddField(
+            model_name='pledge',
+            name='billing_profile',
+            field=models.ForeignKey(blank=True, null=True, related_name='pledges', on_delete=django.db.models.deletion.PROTECT, to='contrib.BillingProfile', help_text='The credit card details to charge.'),
+            preserve_default=True,
+        ),
+    ] + [
+        migrations.AddField(
+            model_name='pledge',
+            name=column,
+            field=models.CharField(max_length=max_length, blank=True, default='', help_text=help_text),
+            preserve_default=True,
+        )
+        for column, max_length, help_text in (
+            ('contrib_name_first', 100, "The contributor's first name."),
+            ('contrib_name_last', 100, "The contributor's last name."),
+            ('contrib_address', 255, "The contributor's street address."),
+            ('contrib_city', 100, "The contributor's city."),
+            ('contrib_state', 20, "The contributor's state."),
+            ('contrib_zip', 16, "The contributor's ZIP code."),
+            ('contrib_occupation', 255, "The contributor's occupation, for campaign finance disclosure."),
+            ('contrib_employer', 255, "The contributor's employer, for campaign finance disclosure."),
+        )
+    ] + [
+        migrations.RunPython(move_extra_to_columns, move_columns_to_extra),
+    ]
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import contrib.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contrib', '0008_pledge_contributor_billingprofile'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GeocodedAddress',
+            fields=[
+                ('id', models.AutoField(auto_created=True, verbose_name='ID', primary_key=True, serialize=False)),
+                ('key', models.CharField(unique=True, max_length=40, help_text='The SHA1 hash of the normalized address.')),
+                ('created', models.DateTimeField(db_index=True, auto_now_add=True)),
+                ('district', models.CharField(max_length=4, help_text='The congressional district of the address, in the form of XX00, or UNKN if the address could not be geocoded.')),
+                ('metadata', contrib.models.JSONField(blank=True, help_text='Other information returned by the geocoder.')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contrib', '0009_geocodedaddress'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='triggerexecution',
+            name='district_updates',
+            field=models.IntegerField(help_text="A count of the times the districts of this execution's PledgeExecutions were set, for keying the things computed from them.", default=0),
+            preserve_default=True,
+        ),
+    ]
@@ -92,6 +92,75 @@ class Trigger(models.Model):
 		# to campaigns, as well as in emails to users with links back to the site.
 		return settings.SITE_ROOT_URL + ("/a/%d" % self.id)
 
+	def save(self, *args, **kwargs):
+		super(Trigger, self).save(*args, **kwargs)
+		Trigger.bump_cache_version(self.id)
+		Trigger.bump_homepage_cache_version()
+
+	# Cache versioning.
+	#
+	# Rendered parts of the trigger page are cached under a version
+	# stamp per trigger, which is bumped whenever something shown on the
+	# page changes: the trigger itself, its pledges, its status updates,
+	# and its execution. A change to one trigger leaves the cached pages
+	# of all other triggers alone.
+
+	CACHE_VERSION_KEY = "trigger_cache_version:%d"
+
+	@staticmethod
+	def bump_cache_version(trigger_id):
+		# Use a random stamp rather than a counter so that a stamp that was
+		# evicted from the cache can't come back with an old value.
+		from django.core.cache import cache
+		import uuid
+		cache.set(Trigger.CACHE_VERSION_KEY % trigger_id, uuid.uuid4().hex, None)
+
+	def get_cache_version(self):
+		# Returns a string to key cached parts of the trigger page on.
+		# The stamp is bumped before the change that bumped it is committed,
+		# so the committed state shown on the page (update times and counts)
+		# is included too. Otherwise a page rendered from data read just
+		# before the commit could be cached under the new stamp.
+		from django.core.cache import cache
+		from django.db.models import Count, Max
+		key = Trigger.CACHE_VERSION_KEY % self.id
+		stamp = cache.get(key)
+		if stamp is None:
+			Trigger.bump_cache_version(self.id)
+			stamp = cache.get(key)
+		try:
+			te = self.execution
+			te_version = "%s.%s" % (te.updated.isoformat(), te.stats_version)
+		except TriggerExecution.DoesNotExist:
+			te_version = ""
+		updates = TriggerStatusUpdate.objects.filter(trigger=self).aggregate(count=Count('id'), updated=Max('updated'))
+		return "%s.%s.%d.%s.%s.%d.%s" % (stamp, self.updated.isoformat(), self.pledge_count, self.total_pledged, te_version,
+			updates['count'], updates['updated'].isoformat() if updates['updated'] else "")
+
+	# The homepage's listings of triggers are cached under a version stamp
+	# that is bumped when any trigger is saved (e.g. its status changes)
+	# or when pledge execution progresses, which is when a trigger can
+	# become done executing. Amounts pledged aren't tracked, so they may
+	# be up to HOMEPAGE_CACHE_TIME seconds old.
+
+	HOMEPAGE_CACHE_VERSION_KEY = "homepage_cache_version"
+	HOMEPAGE_CACHE_TIME = 60*5
+
+	@staticmethod
+	def bump_homepage_cache_version():
+		from django.core.cache import cache
+		import uuid
+		cache.set(Trigger.HOMEPAGE_CACHE_VERSION_KEY, uuid.uuid4().hex, None)
+
+	@staticmethod
+	def get_homepage_cache_version():
+		from django.core.cache import cache
+		stamp = cache.get(Trigger.HOMEPAGE_CACHE_VERSION_KEY)
+		if stamp is None:
+			Trigger.bump_homepage_cache_version()
+			stamp = cache.get(Trigger.HOMEPAGE_CACHE_VERSION_KEY)
+		return stamp
+
 	def get_minimum_pledge(self):
 		alg = Pledge.current_algorithm()
 		m1 = alg['min_contrib']
@@ -113,6 +182,10 @@ class Trigger(models.Model):
 		if trigger.status not in (TriggerStatus.Open, TriggerStatus.Paused):
 			raise ValueError("Trigger is in state %s." % str(trigger.status))
 
+		# Make the pledge counters exact. They're checked to see when the
+		# trigger is done executing.
+		trigger.pledge_count, trigger.total_pledged = Trigger.rollup_pledge_counts(trigger.id)
+
 		# Create TriggerExecution object.
 		te = TriggerExecution()
 		te.trigger = trigger
@@ -127,7 +200,8 @@ class Trigger(models.Model):
 		# actor_outcomes is a dict mapping Actors to outcome indexes
 		# or None if the Actor didn't properly participate or a string
 		# meaning the Actor didn't participate and the string gives
-		# the reason_for_no_outcome value.
+		# the reason_for_no_outcome value. Insert them all at once.
+		actions = []
 		for actor, outcome in actor_outcomes.items():
 			# If an Actor has an inactive_reason set, then we ignore
 			# any outcome supplied to us and replace it with that.
@@ -135,12 +209,47 @@ class Trigger(models.Model):
 			if actor.inactive_reason:
 				outcome = actor.inactive_reason
 
-			ac = Action.create(te, actor, outcome)
+			actions.append(Action.build(te, actor, outcome))
+		Action.objects.bulk_create(actions)
+
+		# Create the ContributionAggregates for the totals overall and by
+		# outcome now, before pledges are executed concurrently. (See
+		# ContributionTotals.flush.)
+		ContributionAggregate.objects.bulk_create([
+			ContributionAggregate(trigger_execution=te, outcome=outcome, district=None)
+			for outcome in [None] + list(range(len(trigger.outcomes)))])
 
 		# Mark as executed.
 		trigger.status = TriggerStatus.Executed
 		trigger.save()
 
+	# Pledge counters.
+	#
+	# Pledges are counted in TriggerPledgeCounter rows, which are spread
+	# over several stripes per trigger so that concurrent pledges don't
+	# all wait on the lock for one row. pledge_count and total_pledged
+	# are a rollup of the stripes, which is updated when the trigger is
+	# executed and every few minutes by the rollup_pledge_counts
+	# management command. Pledges don't update it themselves: the lock
+	# on the Trigger row would be held until the pledge's transaction
+	# commits and serialize pledges again.
+
+	@staticmethod
+	@transaction.atomic
+	def rollup_pledge_counts(trigger_id):
+		# Sets pledge_count and total_pledged from the stripes and returns
+		# them.
+		from django.db.models import Sum
+		list(Trigger.objects.filter(id=trigger_id).select_for_update().values_list('id'))
+
+		totals = TriggerPledgeCounter.objects.filter(trigger_id=trigger_id)\
+			.aggregate(pledge_count=Sum('pledge_count'), total_pledged=Sum('total_pledged'))
+		pledge_count = totals['pledge_count'] or 0
+		total_pledged = totals['total_pledged'] or 0
+		Trigger.objects.filter(id=trigger_id).update(pledge_count=pledge_count, total_pledged=total_pledged)
+		Trigger.bump_cache_version(trigger_id)
+		return pledge_count, total_pledged
+
 	# Vacate, meaning we do not expect the action to ever occur.
 	@transaction.atomic
 	def vacate(self):
@@ -161,6 +270,40 @@ class Trigger(models.Model):
 			p.save()
 
 
+class TriggerPledgeCounter(models.Model):
+	"""One of several stripes of the count and total amount of the pledges made on a Trigger."""
+
+	trigger = models.ForeignKey(Trigger, related_name="pledge_counters", on_delete=models.CASCADE, help_text="The Trigger that this counter is for.")
+	stripe = models.IntegerField(help_text="Which of the Trigger's counters this is.")
+	pledge_count = models.IntegerField(default=0, help_text="This stripe's part of the number of pledges made.")
+	total_pledged = models.DecimalField(max_digits=6, decimal_places=2, default=0, help_text="This stripe's part of the total amount of pledges.")
+
+	class Meta:
+		unique_together = [('trigger', 'stripe')]
+
+	STRIPES = 16
+
+	@staticmethod
+	def increment(trigger, pledge_count, total_pledged):
+		# Adds to a randomly chosen stripe of the Trigger's counters.
+		import random
+		stripe = random.randrange(TriggerPledgeCounter.STRIPES)
+		def update():
+			return TriggerPledgeCounter.objects.filter(trigger=trigger, stripe=stripe).update(
+				pledge_count=models.F('pledge_count') + pledge_count,
+				total_pledged=models.F('total_pledged') + total_pledged)
+		if update():
+			return
+
+		# The stripe doesn't exist yet. Create it, unless someone else
+		# just did.
+		try:
+			with transaction.atomic():
+				TriggerPledgeCounter.objects.create(trigger=trigger, stripe=stripe,
+					pledge_count=pledge_count, total_pledged=total_pledged)
+		except IntegrityError:
+			update()
+
 class TriggerStatusUpdate(models.Model):
 	"""A status update about the Trigger providing further information to users looking at the Trigger that was not known when the Trigger was created."""
 
@@ -170,6 +313,14 @@ class TriggerStatusUpdate(models.Model):
 	text = models.TextField(help_text="Status update text in the format given by text_format.")
 	text_format = EnumField(TextFormat, help_text="The format of the text.")
 
+	def save(self, *args, **kwargs):
+		super(TriggerStatusUpdate, self).save(*args, **kwargs)
+		Trigger.bump_cache_version(self.trigger_id)
+
+	def delete(self):
+		super(TriggerStatusUpdate, self).delete()
+		Trigger.bump_cache_version(self.trigger_id)
+
 class TriggerExecution(models.Model):
 	"""How a Trigger was executed."""
 
@@ -188,12 +339,20 @@ class TriggerExecution(models.Model):
 	pledge_count_with_contribs = models.IntegerField(default=0, help_text="A cached count of the number of pledges executed with actual contributions made.")
 	num_contributions = models.IntegerField(default=0, db_index=True, help_text="A cached total number of campaign contributions executed.")
 	total_contributions = models.DecimalField(max_digits=6, decimal_places=2, default=0, db_index=True, help_text="A cached total amount of campaign contributions executed, excluding fees.")
+	district_updates = models.IntegerField(default=0, help_text="A count of the times the districts of this execution's PledgeExecutions were set, for keying the things computed from them.")
 
 	extra = JSONField(blank=True, help_text="Additional information stored with this object.")
 
 	def __str__(self):
 		return "%s [exec %s]" % (self.trigger, self.created.strftime("%x"))
 
+	def save(self, *args, **kwargs):
+		# Pledge execution progress is saved here, so the trigger page
+		# changes and the trigger may now be listed on the homepage.
+		super(TriggerExecution, self).save(*args, **kwargs)
+		Trigger.bump_cache_version(self.trigger_id)
+		Trigger.bump_homepage_cache_version()
+
 	def get_outcomes(self):
 		# Get the contribution aggregates by outcome
 		# and sort by total amount of contributions.
@@ -208,6 +367,85 @@ class TriggerExecution(models.Model):
 		outcomes.sort(key = lambda x : x['contribs'], reverse=True)
 		return outcomes
 
+	@property
+	def stats_version(self):
+		# A string that changes whenever the contributions made for this
+		# execution change (e.g. a PledgeExecution being deleted), for
+		# keying the things computed from them.
+		return "%d.%d.%s" % (self.pledge_count, self.num_contributions, self.total_contributions)
+
+	def is_complete(self):
+		# Have all of the trigger's pledges been executed?
+		return self.pledge_count == self.trigger.pledge_count
+
+	def get_summary(self):
+		# Returns the summary statistics shown on the trigger page. Once the
+		# trigger is done executing, they are computed once and cached.
+		from django.core.cache import cache
+		key = "trigger_execution_summary:%d:%s" % (self.id, self.stats_version)
+		summary = cache.get(key)
+		if summary is None:
+			summary = self.compute_summary()
+			if self.is_complete():
+				cache.set(key, summary, None)
+		return summary
+
+	def compute_summary(self):
+		# Get the contribution aggregates by outcome and sort by total amount of contributions.
+		outcomes = self.get_outcomes()
+
+		# Actions/Actors. Sort with actors that received no contributions either for or against at
+		# the end of the list, since they're sort of no-data rows. After that, sort by the sum of
+		# the contributions plus the negative of the contributions to their challengers. For ties,
+		# sort alphabetically on name.
+		actions = list(self.actions.all().select_related('actor'))
+		actions.sort(key = lambda a : (
+			a.outcome is None, # non-voting actors at the end
+			(a.total_contributions_for + a.total_contributions_against) == 0, # no contribs either way at end
+			-(a.total_contributions_for - a.total_contributions_against), # sort by contribs for minus contribs against
+			a.reason_for_no_outcome, # among non-voting actors, sort by the reason
+			a.outcome, # among voting actors, group by vote
+			a.actor.name_sort # finally, by last name
+			)
+		)
+		num_recips = 0
+		num_actors = 0
+		for a in actions:
+			if a.total_contributions_for > 0: num_recips += 1
+			if a.total_contributions_against > 0: num_recips += 1
+			if a.total_contributions_for > 0 or a.total_contributions_against > 0: num_actors += 1
+
+		# Incumbent/challengers.
+		by_incumb_chlngr = [["Incumbent", 0, "text-success"], ["Opponent", 0, "text-danger"]]
+		for a in actions:
+			by_incumb_chlngr[0][1] += a.total_contributions_for
+			by_incumb_chlngr[1][1] += a.total_contributions_against
+
+		# Keep just what the trigger page shows for each Action. (Set the
+		# execution so outcome_label doesn't have to query for it.)
+		action_rows = []
+		for a in actions:
+			a.execution = self
+			action_rows.append({
+				"name_long": a.name_long,
+				"has_outcome": a.has_outcome(),
+				"outcome_label": a.outcome_label(),
+				"total_contributions_for": a.total_contributions_for,
+				"total_contributions_against": a.total_contributions_against,
+			})
+
+		# Compute other summary stats.
+		return {
+			"outcomes": outcomes,
+			"actions": action_rows,
+			"by_incumb_chlngr": by_incumb_chlngr,
+			"num_recips": num_recips,
+			"num_actors": num_actors,
+			"num_contribs": self.num_contributions,
+			"avg_pledge": self.total_contributions / self.pledge_count_with_contribs if self.pledge_count_with_contribs else 0,
+			"avg_contrib": self.total_contributions / self.num_contributions if self.num_contributions else 0,
+		}
+
 #####################################################################
 #
 # Actors
@@ -289,6 +527,14 @@ class Action(models.Model):
 
 	@staticmethod
 	def create(execution, actor, outcome):
+		a = Action.build(execution, actor, outcome)
+		a.save()
+		return a
+
+	@staticmethod
+	def build(execution, actor, outcome):
+		# Returns a new, unsaved Action instance.
+		#
 		# outcome can be an integer giving the Trigger's outcome index
 		# that the Actor did . . .
 		if isinstance(outcome, int):
@@ -310,12 +556,11 @@ class Action(models.Model):
 		a.reason_for_no_outcome = reason_for_no_outcome
 
 		# Copy fields that may change on the Actor but that we want to know what they were
-		# at the time this Action ocurred.
-		for f in ('name_long', 'name_short', 'name_sort', 'party', 'title', 'extra', 'challenger'):
+		# at the time this Action ocurred. (Copy the challenger by id so we don't have to
+		# load it.)
+		for f in ('name_long', 'name_short', 'name_sort', 'party', 'title', 'extra', 'challenger_id'):
 			setattr(a, f, getattr(actor, f))
 
-		# Save.
-		a.save()
 		return a
 
 
@@ -345,6 +590,17 @@ class NoMassDeleteManager(models.Manager):
 	def get_queryset(self):
 		return NoMassDeleteManager.CustomQuerySet(self.model, using=self._db)
 
+class BillingProfile(models.Model):
+	"""Credit card details from an authorization test, shared by all of the Pledges that re-use them."""
+
+	created = models.DateTimeField(auto_now_add=True, db_index=True)
+
+	cc_num_hashed = models.CharField(max_length=128, help_text="A password hash of the credit card number, for verifying a look-up of pledges by card number.")
+	cc_exp_month = models.IntegerField(help_text="The card's expiration month, so we know if it has expired before using the token.")
+	cc_exp_year = models.IntegerField(help_text="The card's expiration year.")
+	de_cc_token = models.CharField(max_length=128, unique=True, help_text="The Democracy Engine credit card token for making charges.")
+	authorization = JSONField(blank=True, help_text="The Democracy Engine response to the authorization test.")
+
 class Pledge(models.Model):
 	"""A user's pledge of a contribution."""
 
@@ -367,7 +623,18 @@ class Pledge(models.Model):
 	filter_party = EnumField(ActorParty, blank=True, null=True, help_text="Contributions only go to candidates whose party matches this party. Independent is not an allowed value here.")
 	filter_competitive = models.BooleanField(default=False, help_text="Whether to filter contributions to competitive races.")
 
+	contrib_name_first = models.CharField(max_length=100, blank=True, default="", help_text="The contributor's first name.")
+	contrib_name_last = models.CharField(max_length=100, blank=True, default="", help_text="The contributor's last name.")
+	contrib_address = models.CharField(max_length=255, blank=True, default="", help_text="The contributor's street address.")
+	contrib_city = models.CharField(max_length=100, blank=True, default="", help_text="The contributor's city.")
+	contrib_state = models.CharField(max_length=20, blank=True, default="", help_text="The contributor's state.")
+	contrib_zip = models.CharField(max_length=16, blank=True, default="", help_text="The contributor's ZIP code.")
+	contrib_occupation = models.CharField(max_length=255, blank=True, default="", help_text="The contributor's occupation, for campaign finance disclosure.")
+	contrib_employer = models.CharField(max_length=255, blank=True, default="", help_text="The contributor's employer, for campaign finance disclosure.")
+
+	billing_profile = models.ForeignKey(BillingProfile, blank=True, null=True, related_name="pledges", on_delete=models.PROTECT, help_text="The credit card details to charge.")
 	cclastfour = models.CharField(max_length=4, blank=True, null=True, db_index=True, help_text="The last four digits of the user's credit card number, stored & indexed for fast look-up in case we need to find a pledge from a credit card number.")
+	cc_fingerprint = models.CharField(max_length=64, blank=True, null=True, db_index=True, help_text="A keyed hash (HMAC) of the user's credit card number, stored & indexed for exact look-up of a pledge from a credit card number.")
 
 	email_confirmed_at = models.DateTimeField(blank=True, null=True, help_text="The date and time that the email address of the pledge became confirmed, if the pledge was originally based on an unconfirmed email address.")
 	pre_execution_email_sent_at = models.DateTimeField(blank=True, null=True, help_text="The date and time when the user was sent an email letting them know that their pledge is about to be executed.")
@@ -382,33 +649,49 @@ class Pledge(models.Model):
 
 	ENFORCE_EXECUTION_EMAIL_DELAY = True # can disable for testing
 
+	# The names of the pledge form fields for the contributor columns.
+	CONTRIBUTOR_FIELDS = (
+		('contribNameFirst', 'contrib_name_first'),
+		('contribNameLast', 'contrib_name_last'),
+		('contribAddress', 'contrib_address'),
+		('contribCity', 'contrib_city'),
+		('contribState', 'contrib_state'),
+		('contribZip', 'contrib_zip'),
+		('contribOccupation', 'contrib_occupation'),
+		('contribEmployer', 'contrib_employer'),
+	)
+
 	@transaction.atomic
 	def save(self, *args, **kwargs):
 		# Override .save() so on the INSERT of a new Pledge we increment
 		# counters on the Trigger.
 		is_new = (not self.id) # if the pk evaluates to false, Django does an INSERT
 
+		# Save a new BillingProfile from an authorization test. It was assigned
+		# before it had an id, so copy its new id into billing_profile_id.
+		if self.billing_profile_id is None and self.billing_profile is not None:
+			self.billing_profile.save()
+			self.billing_profile_id = self.billing_profile.id
+
 		# Actually save().
 		super(Pledge, self).save(*args, **kwargs)
 
-		# For a new object, increment the trigger's pledge_count and total_pledged
-		# fields (atomically).
+		# For a new object, increment the trigger's pledge counters. They
+		# are rolled up into the trigger's pledge_count and total_pledged
+		# fields later.
 		if is_new:
-			from django.db import models
-			t = self.trigger
-			t.pledge_count = models.F('pledge_count') + 1
-			t.total_pledged = models.F('total_pledged') + self.amount
-			t.save(update_fields=['pledge_count', 'total_pledged'])
+			TriggerPledgeCounter.increment(self.trigger, 1, self.amount)
+
+		# The trigger page may have changed.
+		Trigger.bump_cache_version(self.trigger_id)
 
 	@transaction.atomic
 	def delete(self):
 		if self.status != PledgeStatus.Open:
 			raise ValueError("Cannot cancel a Pledge with status %s." % self.status)
 
-		# Decrement the Trigger's pledge_count and total_pledged.
-		self.trigger.pledge_count = models.F('pledge_count') - 1
-		self.trigger.total_pledged = models.F('total_pledged') - self.amount
-		self.trigger.save(update_fields=['pledge_count', 'total_pledged'])
+		# Decrement the Trigger's pledge counters.
+		TriggerPledgeCounter.increment(self.trigger, -1, -self.amount)
 
 		# Archive as a cancelled pledge.
 		cp = CancelledPledge.from_pledge(self)
@@ -417,6 +700,8 @@ class Pledge(models.Model):
 		# the pledge has been executed and a PledgeExecution object refers to this.
 		super(Pledge, self).delete()	
 
+		Trigger.bump_cache_version(self.trigger_id)
+
 	@staticmethod
 	def current_algorithm():
 		return {
@@ -431,6 +716,28 @@ class Pledge(models.Model):
 	def __str__(self):
 		return self.get_email() + " => " + str(self.trigger)
 
+	@staticmethod
+	def get_user_summary(user):
+		# Returns the user's total amount of open pledges (i.e. their total
+		# possible future credit card charges), their total amount of executed
+		# campaign contributions, and the number of pledges in each status,
+		# computed with a single grouped query.
+		from django.db.models import Sum, Count
+		summary = {
+			"total_pledged": 0,
+			"total_contribs": 0,
+			"counts": { status.name: 0 for status in PledgeStatus },
+		}
+		for row in Pledge.objects.filter(user=user).order_by().values('status').annotate(
+			count=Count('id'), amount=Sum('amount'), charged=Sum('execution__charged')):
+			status = PledgeStatus(row['status'])
+			summary["counts"][status.name] = row['count']
+			if status == PledgeStatus.Open:
+				summary["total_pledged"] = row['amount'] or 0
+			elif status == PledgeStatus.Executed:
+				summary["total_contribs"] = row['charged'] or 0
+		return summary
+
 	def get_email(self):
 		if self.user:
 			return self.user.email
@@ -565,10 +872,25 @@ class Pledge(models.Model):
 	def find_from_billing(cc_number):
 		# Returns an interator that yields matchinig Pledge instances.
 		# Must be in parallel to how the view function creates the pledge.
+		# Pledges are found by their indexed card fingerprint, and the
+		# (slow) password hash of the number is checked just to confirm.
 		from django.contrib.auth.hashers import check_password
+		from contrib.bizlogic import cc_fingerprint
 		cc_number = cc_number.replace(' ', '')
-		for p in Pledge.objects.filter(cclastfour=cc_number[-4:]):
-			if check_password(cc_number, p.extra['billing']['cc_num_hashed']):
+		fingerprint = cc_fingerprint(cc_number)
+		for p in Pledge.objects.filter(cc_fingerprint=fingerprint).select_related('billing_profile'):
+			if p.billing_profile and check_password(cc_number, p.billing_profile.cc_num_hashed):
+				yield p
+
+		# Pledges made before fingerprints were stored can only be found
+		# by checking the hash of every pledge with the same last four
+		# digits. Store the fingerprint of any we find so that next time
+		# they're found by the index. (See the backfill_cc_fingerprints
+		# management command.)
+		for p in Pledge.objects.filter(cclastfour=cc_number[-4:], cc_fingerprint=None).select_related('billing_profile'):
+			if p.billing_profile and check_password(cc_number, p.billing_profile.cc_num_hashed):
+				Pledge.objects.filter(id=p.id).update(cc_fingerprint=fingerprint)
+				p.cc_fingerprint = fingerprint
 				yield p
 
 	def needs_pre_execution_email(self):
@@ -584,10 +906,18 @@ class Pledge(models.Model):
 		return True
 
 	@transaction.atomic
-	def execute(self):
-		# Lock the Pledge and the Trigger to prevent race conditions.
+	def execute(self, recipient_plans=None):
+		# recipient_plans is an optional bizlogic.RecipientPlans shared by
+		# the pledges executed in one run.
+
+		# Lock the Pledge to prevent race conditions, e.g. two workers
+		# executing the same pledge. We don't lock the Trigger: an
+		# Executed trigger can't change state again, and the counters
+		# on the TriggerExecution are updated atomically with F()
+		# expressions below, so pledges on the same trigger can be
+		# executed concurrently.
 		pledge = Pledge.objects.select_for_update().filter(id=self.id).first()
-		trigger = Trigger.objects.select_for_update().filter(id=pledge.trigger.id).first()
+		trigger = Trigger.objects.select_related('execution').get(id=pledge.trigger_id)
 		trigger_execution = trigger.execution
 
 		# Validate state.
@@ -619,7 +949,7 @@ class Pledge(models.Model):
 			# Get the actual recipients of the pledge, as a list of tuples of
 			# (Recipient, Action). The pledge filters may result in there being
 			# no actual recipients.
-			recipients = get_pledge_recipients(trigger, pledge)
+			recipients = get_pledge_recipients(trigger, pledge, recipient_plans)
 
 			if len(recipients) == 0:
 				# If there are no matching recipients, we don't make a credit card chage.
@@ -670,7 +1000,8 @@ class Pledge(models.Model):
 			}
 			pe.save()
 
-			# Create Contribution objects.
+			# Create Contribution objects, all in one INSERT.
+			contribs = []
 			for recipient, action, amount in recip_contribs:
 				c = Contribution()
 				c.pledge_execution = pe
@@ -678,10 +1009,21 @@ class Pledge(models.Model):
 				c.recipient = recipient
 				c.amount = amount
 				c.de_id = recipient.de_id
-				c.save()
-
-				# Increment the TriggerExecution and Action's total_contributions.
-				c.inc_action_contrib_total()
+				contribs.append(c)
+			Contribution.objects.bulk_create(contribs)
+
+			# bulk_create doesn't give us back the primary keys, so fetch them
+			# in one query. A PledgeExecution has one Contribution per Action.
+			if contribs:
+				ids = dict(pe.contributions.values_list('action_id', 'id'))
+				for c in contribs:
+					c.id = ids[c.action_id]
+
+			# Increment the TriggerExecution and Action's total_contributions.
+			totals = ContributionTotals()
+			for c in contribs:
+				totals.add(c)
+			totals.flush()
 
 			# Mark pledge as executed.
 			pledge.status = PledgeStatus.Executed
@@ -768,8 +1110,15 @@ class PledgeExecution(models.Model):
 
 	@transaction.atomic
 	def delete(self, allow_credit=False):
-		# Delete the contributions explicitly so that .delete() gets called (by our manager).
-		self.contributions.all().delete()
+		# Delete the contributions, decrementing the cached totals for all
+		# of them at once. (Contribution.delete would do it one by one.)
+		totals = ContributionTotals()
+		contribs = self.contributions.all().select_related('recipient')
+		for c in contribs:
+			c.pledge_execution = self
+			totals.add(c, factor=-1)
+		totals.flush()
+		models.QuerySet.delete(contribs)
 
 		# Return the Pledge to the open state so we can try to execute again.
 		self.pledge.status = PledgeStatus.Open
@@ -816,22 +1165,76 @@ class PledgeExecution(models.Model):
 			return "Your contribution was not made because there were no %s that met your criteria of %s." \
 				% (self.pledge.trigger.trigger_type.strings['actors'], self.pledge.targets_summary)
 
-	@transaction.atomic
 	def update_district(self, district, other):
-		# lock so we don't overwrite
-		self = PledgeExecution.objects.filter(id=self.id).select_for_update().get()
+		PledgeExecution.update_districts({ self.id: (district, other) })
 
-		# temporarily decrement all of the contributions from the aggregates
-		for c in self.contributions.all():
-			c.inc_action_contrib_total(factor=-1)
+	@staticmethod
+	@transaction.atomic
+	def update_districts(districts):
+		# Sets the districts of many PledgeExecutions at once. districts
+		# maps PledgeExecution ids to (district, other) tuples, where other
+		# is geocoder metadata. Returns the number of PledgeExecutions updated.
 
+		# lock so we don't overwrite
+		pes = list(PledgeExecution.objects.filter(id__in=districts).select_for_update().select_related('pledge'))
+
+		# Get all of their contributions at once.
+		contribs = { pe.id: [] for pe in pes }
+		for c in Contribution.objects.filter(pledge_execution__in=pes).select_related('recipient'):
+			contribs[c.pledge_execution_id].append(c)
+
+		# Move all of the contributions from the aggregates for the old
+		# districts to the aggregates for the new districts. Only the
+		# net change is written, all together.
+		totals = ContributionTotals()
+		for pe in pes:
+			for c in contribs[pe.id]:
+				c.pledge_execution = pe
+			pe.add_district_change(totals, districts[pe.id][0], contribs[pe.id])
+		totals.flush()
+
+		for pe in pes:
+			pe.district, pe.extra['geocode'] = districts[pe.id]
+			pe.save(update_fields=['district', 'extra'])
+
+		# The trigger reports list donors' districts.
+		TriggerExecution.objects.filter(id__in=set(pe.trigger_execution_id for pe in pes))\
+			.update(district_updates=models.F('district_updates') + 1)
+
+		return len(pes)
+
+	def add_district_change(self, totals, district, contribs=None):
+		# Record in a ContributionTotals the change to the aggregates from
+		# moving this PledgeExecution's contributions to a new district.
+		# Doesn't change self.district. The caller may pass the contributions
+		# if it already has them.
+		if contribs is None:
+			contribs = list(self.contributions.all().select_related('recipient'))
+		old_district = self.district
+		for c in contribs:
+			c.pledge_execution = self
+			totals.add(c, factor=-1)
 		self.district = district
-		self.extra['geocode'] = other
-		self.save(update_fields=['district', 'extra'])
+		for c in contribs:
+			totals.add(c, factor=1)
+		self.district = old_district
+
+class GeocodedAddress(models.Model):
+	"""A cached result of geocoding a contributor address to a congressional district."""
+
+	key = models.CharField(max_length=40, unique=True, help_text="The SHA1 hash of the normalized address.")
+	created = models.DateTimeField(auto_now_add=True, db_index=True)
+	district = models.CharField(max_length=4, help_text="The congressional district of the address, in the form of XX00, or UNKN if the address could not be geocoded.")
+	metadata = JSONField(blank=True, help_text="Other information returned by the geocoder.")
 
-		# re-increment now that the district is set
-		for c in self.contributions.all():
-			c.inc_action_contrib_total(factor=1)
+	@staticmethod
+	def make_key(address):
+		# Normalize the (address, city, state, zip) parts so that the same
+		# address typed slightly differently has the same key.
+		import re, hashlib
+		parts = [re.sub(r"[^a-z0-9]+", " ", (part or "").lower()).strip() for part in address]
+		parts[3] = parts[3][0:5] # ZIP+4 => ZIP
+		return hashlib.sha1("|".join(parts).encode("utf8")).hexdigest()
 
 #####################################################################
 #
@@ -869,7 +1272,7 @@ class Recipient(models.Model):
 
 	@property
 	def is_challenger(self):
-		return self.actor is None
+		return self.actor_id is None
 
 class Contribution(models.Model):
 	"""A fully executed campaign contribution."""
@@ -915,36 +1318,124 @@ class Contribution(models.Model):
 		super(Contribution, self).delete()	
 
 	def inc_action_contrib_total(self, factor=1):
-		# Increment the totals on the Action instance. This excludes fees because
-		# this is based on transaction line items.
-		if not self.recipient.is_challenger:
+		# Increment the cached totals on the Action, TriggerExecution, and
+		# ContributionAggregates for this one contribution.
+		totals = ContributionTotals()
+		totals.add(self, factor=factor)
+		totals.flush()
+
+class ContributionTotals(object):
+	"""Accumulates changes to the cached contribution totals on Action, TriggerExecution, and ContributionAggregate so they can be written in a handful of queries."""
+
+	def __init__(self):
+		self.actions = { } # (action id, field name) => amount
+		self.executions = { } # TriggerExecution id => [amount, count]
+		self.aggregates = { } # (TriggerExecution id, outcome, district) => amount
+
+	def add(self, contribution, factor=1):
+		# Record the change to the totals for a Contribution being made
+		# (factor=1) or removed (factor=-1). The district and desired
+		# outcome are read from the PledgeExecution now, so that a
+		# district change can be recorded as a removal followed by
+		# an addition.
+		c = contribution
+		amount = c.amount*factor
+		te_id = c.pledge_execution.trigger_execution_id
+
+		# The totals on the Action exclude fees because this is based on
+		# transaction line items.
+		if not c.recipient.is_challenger:
 			# Contribution was to the Actor.
 			field = 'total_contributions_for'
 		else:
 			# Contribution was to the Actor's opponent.
 			field = 'total_contributions_against'
-		setattr(self.action, field, models.F(field) + self.amount*factor)
-		self.action.save(update_fields=[field])
-
-		# Increment the TriggerExecution's total_contributions. Likewise, it
-		# excludes fees.
-		self.action.execution.total_contributions = models.F('total_contributions') + self.amount*factor
-		self.action.execution.num_contributions = models.F('num_contributions') + 1*factor
-		self.action.execution.save(update_fields=['total_contributions', 'num_contributions'])
-
-		# Increment the cached ContributionAggregate for the desired outcome.
-		# Note that Pledge.district is None before we've done the look-up,
-		# and we'll just omit those from the aggregates.
-		slices = []
-		for outcome in (None, self.pledge_execution.pledge.desired_outcome):
-			for district in set([None, self.pledge_execution.district]):
-				slices.append({ "outcome": outcome, "district": district })
-		for slce in slices:
-			agg, is_new = ContributionAggregate.objects.get_or_create(
-				trigger_execution=self.action.execution,
-				**slce)
-			agg.total = models.F('total') + self.amount*factor
-			agg.save(update_fields=['total'])
+		key = (c.action_id, field)
+		self.actions[key] = self.actions.get(key, 0) + amount
+
+		# The TriggerExecution's total_contributions likewise excludes fees.
+		te = self.executions.setdefault(te_id, [0, 0])
+		te[0] += amount
+		te[1] += factor
+
+		# The cached ContributionAggregate for the desired outcome.
+		# Note that PledgeExecution.district is None before we've done
+		# the look-up, and we'll just omit those from the aggregates.
+		for outcome in (None, c.pledge_execution.pledge.desired_outcome):
+			for district in set([None, c.pledge_execution.district]):
+				key = (te_id, outcome, district)
+				self.aggregates[key] = self.aggregates.get(key, 0) + amount
+
+	@staticmethod
+	def _group_by_amount(deltas):
+		# Turn a dict of key => amount into a dict of amount => [keys],
+		# skipping changes that cancelled out. All of the contributions
+		# for a pledge have the same amount, so this groups the rows we
+		# need to update into very few UPDATE queries.
+		ret = { }
+		for key, amount in deltas.items():
+			if amount == 0: continue
+			ret.setdefault(amount, []).append(key)
+		return ret
+
+	@staticmethod
+	def _slices_filter(slices):
+		# Build a filter matching ContributionAggregate rows for a list of
+		# (outcome, district) slices, where None must match a NULL.
+		from django.db.models import Q
+		q = None
+		for outcome, district in slices:
+			s = (Q(outcome=outcome) if outcome is not None else Q(outcome__isnull=True)) \
+			  & (Q(district=district) if district is not None else Q(district__isnull=True))
+			q = s if q is None else (q | s)
+		return q
+
+	@transaction.atomic
+	def flush(self):
+		# Write the accumulated changes and reset.
+
+		# Actions.
+		for amount, keys in ContributionTotals._group_by_amount(self.actions).items():
+			for field in set(field for action_id, field in keys):
+				Action.objects.filter(id__in=[action_id for action_id, f in keys if f == field])\
+					.update(**{ field: models.F(field) + amount })
+
+		# TriggerExecutions.
+		for te_id, (amount, count) in self.executions.items():
+			if amount == 0 and count == 0: continue
+			TriggerExecution.objects.filter(id=te_id).update(
+				total_contributions=models.F('total_contributions') + amount,
+				num_contributions=models.F('num_contributions') + count)
+
+		# ContributionAggregates, by TriggerExecution.
+		for te_id in set(key[0] for key in self.aggregates):
+			deltas = { key[1:]: amount for key, amount in self.aggregates.items() if key[0] == te_id }
+			slices = [key for key, amount in deltas.items() if amount != 0]
+			if not slices: continue
+			aggs = ContributionAggregate.objects.filter(trigger_execution_id=te_id)
+
+			# Create the slices that don't exist yet. (The slices without a
+			# district are created when the trigger is executed, so this is
+			# only for districts seen for the first time.) Pledges on the same
+			# trigger are executed concurrently, and the unique constraint
+			# doesn't stop two of them from creating the same slice when the
+			# outcome or district is NULL, so lock the TriggerExecution and
+			# look again before creating them.
+			existing = set(aggs.filter(ContributionTotals._slices_filter(slices)).values_list('outcome', 'district'))
+			missing = [slce for slce in slices if slce not in existing]
+			if missing:
+				list(TriggerExecution.objects.select_for_update().filter(id=te_id).values_list('id'))
+				existing = set(aggs.filter(ContributionTotals._slices_filter(missing)).values_list('outcome', 'district'))
+				ContributionAggregate.objects.bulk_create([
+					ContributionAggregate(trigger_execution_id=te_id, outcome=outcome, district=district)
+					for outcome, district in missing if (outcome, district) not in existing])
+
+			# Update the totals.
+			for amount, slices in ContributionTotals._group_by_amount(deltas).items():
+				aggs.filter(ContributionTotals._slices_filter(slices))\
+					.update(total=models.F('total') + amount)
+
+		self.__init__()
 
 class ContributionAggregate(models.Model):
 	"""Aggregate totals for various slices of contributions."""
@@ -0,0 +1,192 @@
+# Reports of executed triggers and contributions.
+# -----------------------------------------------
+#
+# A trigger report lists every donor and every contribution made for a trigger,
+# which can be hundreds of thousands of rows. The report is written out
+# incrementally from querysets rather than being built in memory, and
+# once the trigger is done executing it is generated just once into a
+# file named by the execution's stats_version and district_updates so
+# that it's regenerated if the contributions or the donors' districts
+# ever change.
+
+import os, os.path, glob, json, tempfile, csv
+
+from django.conf import settings
+
+from contrib.utils import JSONEncoder
+
+def iter_trigger_execution_report(te):
+	# Yields the JSON report for a TriggerExecution in chunks of text.
+	from contrib.models import PledgeExecutionProblem, Contribution, Recipient
+
+	trigger = te.trigger
+	outcome_labels = [outcome["label"] for outcome in trigger.outcomes]
+
+	def dump(obj):
+		return json.dumps(obj, cls=JSONEncoder, sort_keys=True)
+
+	def dump_list(key, items, first=False):
+		yield ("{\n" if first else ",\n") + dump(key) + ": ["
+		sep = "\n"
+		for item in items:
+			yield sep + dump(item)
+			sep = ",\n"
+		yield "\n]"
+
+	# Aggregates by actor. There is one Action per actor, so this is small.
+	actions = list(te.actions.all().select_related('actor'))
+	actions.sort(key = lambda a : ((a.total_contributions_for + a.total_contributions_against) == 0, -(a.total_contributions_for - a.total_contributions_against), a.actor.name_sort))
+	def build_actor_info(action):
+		action.execution = te # don't re-query it in outcome_label()
+		ret = {
+			"name": action.name_long,
+			"action": action.outcome_label(),
+			"contribs": action.total_contributions_for,
+			"contribs_to_opponent": action.total_contributions_against,
+			"actor_id": action.actor.id,
+		}
+		legislator = (action.extra or {}).get('legislators-current', {})
+		for idscheme in ('bioguide', 'govtrack', 'opensecrets'):
+			if idscheme in legislator.get('id', {}):
+				ret[idscheme+"_id"] = legislator['id'][idscheme]
+		for key in ('state', 'district', 'url', 'end'):
+			v = legislator.get('term', {}).get(key)
+			if key == 'url': key = 'homepage'
+			if key == 'end': key = 'term_end'
+			if v:
+				ret[key] = v
+		return ret
+	yield from dump_list("actors", (build_actor_info(a) for a in actions), first=True)
+
+	# All contributions. The recipients are few, so load them up front.
+	contributions = Contribution.objects.filter(pledge_execution__trigger_execution=te)
+	recipients = Recipient.objects.in_bulk(list(contributions.values_list('recipient_id', flat=True).distinct()))
+	def build_contribution_info(c):
+		# The Action is for the incumbent, whether the recipient is the
+		# incumbent or the incumbent's challenger.
+		r = recipients[c['recipient_id']]
+		return {
+			'amount': c['amount'],
+			'donor_congressional_district': c['pledge_execution__district'],
+			'donor_desired_outcome': outcome_labels[c['pledge_execution__pledge__desired_outcome']],
+			'recipient_name': c['action__name_long'] if not r.is_challenger
+				else r.party.name + " Challenger to " + c['action__name_long'],
+			'recipient_actor_id' if not r.is_challenger else "incumbent_actor_id":
+				c['action__actor_id'],
+		}
+	yield from dump_list("contributions", (build_contribution_info(c) for c in
+		contributions.order_by('id').values('amount', 'recipient_id', 'action__name_long', 'action__actor_id',
+			'pledge_execution__district', 'pledge_execution__pledge__desired_outcome').iterator()))
+
+	# All donors.
+	yield from dump_list("donors", ({
+		"desired_outcome": outcome_labels[pe['pledge__desired_outcome']],
+		"contribs": pe['charged']-pe['fees'],
+		"congressional_district": pe['district'],
+		"date": pe['pledge__created'],
+	} for pe in te.pledges.filter(problem=PledgeExecutionProblem.NoProblem).order_by('id')
+		.values('charged', 'fees', 'district', 'pledge__desired_outcome', 'pledge__created').iterator()))
+
+	# Aggregates by outcome.
+	yield ",\n" + dump("outcomes") + ": " + dump(te.get_outcomes()) + "\n}\n"
+
+def get_trigger_execution_report_file(te):
+	# Returns the path to a file containing the report for a TriggerExecution
+	# that is done executing, generating it if it doesn't exist yet.
+	fn = os.path.join(settings.TRIGGER_REPORT_DIR, "%d-%s.%d.json" % (te.trigger.id, te.stats_version, te.district_updates))
+	if os.path.exists(fn):
+		return fn
+
+	# Write to a temporary file and then move it into place so that
+	# a concurrent request never sees a partial report.
+	os.makedirs(settings.TRIGGER_REPORT_DIR, exist_ok=True)
+	with tempfile.NamedTemporaryFile(mode="w", dir=settings.TRIGGER_REPORT_DIR, suffix=".tmp", delete=False) as f:
+		try:
+			for chunk in iter_trigger_execution_report(te):
+				f.write(chunk)
+		except:
+			os.unlink(f.name)
+			raise
+	os.replace(f.name, fn)
+
+	# Remove any reports for previous versions.
+	for old_fn in glob.glob(os.path.join(settings.TRIGGER_REPORT_DIR, "%d-*.json" % te.trigger.id)):
+		if old_fn != fn:
+			try:
+				os.unlink(old_fn)
+			except FileNotFoundError:
+				pass # removed by a concurrent request
+
+	return fn
+
+def iter_line_items(contributions, executions):
+	# Yields the line items of the Contributions and the fees of the
+	# PledgeExecutions in the given querysets, most recent first. Each
+	# queryset is read in the order of the line items from the database
+	# and the two are merged as they stream, so nothing is sorted or
+	# held in memory.
+	def contrib_line_item(c):
+		return {
+			'when': c.pledge_execution.created,
+			'amount': c.amount,
+			'recipient': c.name_long(),
+			'trigger': c.pledge_execution.trigger_execution.trigger,
+			'email': c.pledge_execution.pledge.get_email(),
+			'sort': (c.pledge_execution.created, 1, c.id),
+		}
+	def fees_line_item(p):
+		return {
+			'when': p.created,
+			'amount': p.fees,
+			'recipient': 'if.then.fund fees',
+			'trigger': p.trigger_execution.trigger,
+			'email': p.pledge.get_email(),
+			'sort': (p.created, 0, p.id),
+		}
+	return merge_descending(
+		(contrib_line_item(c) for c in contributions
+			.select_related('pledge_execution', 'pledge_execution__pledge', 'pledge_execution__pledge__user', 'recipient', 'action', 'pledge_execution__trigger_execution__trigger')
+			.order_by('-pledge_execution__created', '-id').iterator()),
+		(fees_line_item(p) for p in executions
+			.select_related('pledge', 'pledge__user', 'trigger_execution__trigger')
+			.order_by('-created', '-id').iterator()))
+
+def merge_descending(a, b):
+	# Merges two iterators of line items that are each in descending
+	# order of their 'sort' keys. (heapq.merge can't merge in descending
+	# order before Python 3.5.)
+	a, b = iter(a), iter(b)
+	x, y = next(a, None), next(b, None)
+	while x is not None or y is not None:
+		if y is None or (x is not None and x['sort'] >= y['sort']):
+			yield x
+			x = next(a, None)
+		else:
+			yield y
+			y = next(b, None)
+
+def line_items_csv_response(items, trigger_url, filename, with_email=False):
+	# Returns a StreamingHttpResponse for a CSV file of the line items
+	# from iter_line_items. trigger_url is a function that returns the
+	# URL to show for a Trigger.
+	from django.http import StreamingHttpResponse
+
+	class Echo(object):
+		# csv.writer writes each row to this, which just returns it.
+		def write(self, value):
+			return value
+	writer = csv.writer(Echo())
+
+	def iter_rows():
+		yield ['date', 'amount', 'recipient', 'action'] + (['email'] if with_email else [])
+		for item in items:
+			yield [
+				item['when'].isoformat(),
+				item['amount'],
+				item['recipient'],
+				trigger_url(item['trigger']),
+				] + ([item['email']] if with_email else [])
+
+	resp = StreamingHttpResponse((writer.writerow(row) for row in iter_rows()), content_type="text/csv")
+	resp['Content-Disposition'] = 'attachment; filename="%s"' % filename
+	return resp
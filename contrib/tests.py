@@ -171,16 +171,20 @@ class ExecutionTestCase(TestCase):
 			if actor_outcomes[actor] == 2:
 				actor_outcomes[actor] = "Reason for not having an outcome."
 
-		# Execute.
+		# Execute. The number of queries should not depend on the number of Actors.
+		from django.db import connection
+		from django.test.utils import CaptureQueriesContext
 		from django.utils.timezone import now
 		trigger = Trigger.objects.get(key="test")
-		trigger.execute(
-			now(),
-			actor_outcomes,
-			"The trigger has been executed.",
-			TextFormat.Markdown,
-			{
-			})
+		with CaptureQueriesContext(connection) as queries:
+			trigger.execute(
+				now(),
+				actor_outcomes,
+				"The trigger has been executed.",
+				TextFormat.Markdown,
+				{
+				})
+		self.assertLess(len(queries), 10)
 
 		# Refresh object because .status is updated on a copy.
 		trigger = Trigger.objects.get(key="test")
@@ -194,6 +198,11 @@ class ExecutionTestCase(TestCase):
 		self.assertEqual(trigger.execution.num_contributions, 0)
 		self.assertEqual(trigger.execution.total_contributions, 0)
 
+		# The aggregates overall and by outcome exist already.
+		self.assertEqual(
+			set(ContributionAggregate.objects.filter(trigger_execution=trigger.execution).values_list('outcome', 'district')),
+			set([(None, None), (0, None), (1, None)]))
+
 		# There should be the same number of Actions as Actors.
 		self.assertEqual(Action.objects.count(), Actor.objects.count())
 		for action in Action.objects.all():
@@ -258,11 +267,9 @@ class ExecutionTestCase(TestCase):
 		self._pledge_execution(desired_outcome=0, amount=decimal.Decimal('.3'), incumb_challgr=0, filter_party=None, expected_contrib_amount=None,
 			expected_problem=PledgeExecutionProblem.TransactionFailed, expected_problem_string="The amount is not enough to divide evenly across 27 recipients.")
 
-	def _pledge_execution(self, desired_outcome, amount, incumb_challgr, filter_party, expected_contrib_amount,
-		expected_problem=None, expected_problem_string=None):
-
+	def _create_pledge(self, email, desired_outcome, amount, incumb_challgr, filter_party):
 		# Create a user.
-		user = User.objects.create(email="test@example.com")
+		user = User.objects.create(email=email)
 
 		# Create a pledge.
 		p = Pledge.objects.create(
@@ -274,18 +281,15 @@ class ExecutionTestCase(TestCase):
 			incumb_challgr=incumb_challgr,
 			filter_party=filter_party,
 			cclastfour='1111',
-			extra={
-				'contributor': {
-					'contribNameFirst': 'FIRST',
-					'contribNameLast': 'LAST',
-					'contribAddress': 'ADDRESS',
-					'contribCity': 'CITY',
-					'contribState': 'NY',
-					'contribZip': '00000',
-					'contribOccupation': 'OCCUPATION',
-					'contribEmployer': 'EMPLOYER',
-				},
-			}
+			contrib_name_first='FIRST',
+			contrib_name_last='LAST',
+			contrib_address='ADDRESS',
+			contrib_city='CITY',
+			contrib_state='NY',
+			contrib_zip='00000',
+			contrib_occupation='OCCUPATION',
+			contrib_employer='EMPLOYER',
+			extra={ },
 		)
 
 		# Set billing info.
@@ -293,7 +297,196 @@ class ExecutionTestCase(TestCase):
 		run_authorization_test(p, "4111 1111 1111 1111", 9, 2021, '999', { "unittest": True } )
 		p.save()
 
-		# Check that the trigger now has a pledge.
+		return p
+
+	def test_find_from_billing(self):
+		p = self._create_pledge("test@example.com", 0, 10, 0, None)
+		self.assertEqual(list(Pledge.find_from_billing("4111111111111111")), [p])
+		self.assertEqual(list(Pledge.find_from_billing("4111111111111112")), [])
+
+		# Pledges made before fingerprints were stored are found by their
+		# hash and then get a fingerprint.
+		Pledge.objects.filter(id=p.id).update(cc_fingerprint=None)
+		self.assertEqual(list(Pledge.find_from_billing("4111 1111 1111 1111")), [p])
+		self.assertEqual(Pledge.objects.get(id=p.id).cc_fingerprint, p.cc_fingerprint)
+
+	def test_trigger_cache_version(self):
+		t1 = Trigger.objects.get(key="test")
+		t2 = Trigger.objects.create(
+			key="test2",
+			title="Test Trigger 2",
+			trigger_type=t1.trigger_type,
+			slug="test-trigger-2",
+			description="This is another test trigger.",
+			description_format=TextFormat.Markdown,
+			outcomes=t1.outcomes,
+			extra={ },
+			)
+		v1 = t1.get_cache_version()
+		v2 = t2.get_cache_version()
+		self.assertEqual(Trigger.objects.get(id=t1.id).get_cache_version(), v1)
+
+		# A pledge changes the version of its trigger only.
+		self._create_pledge("test@example.com", 0, 10, 0, None)
+		self.assertNotEqual(Trigger.objects.get(id=t1.id).get_cache_version(), v1)
+		self.assertEqual(Trigger.objects.get(id=t2.id).get_cache_version(), v2)
+
+		# So does a status update.
+		v2 = Trigger.objects.get(id=t2.id).get_cache_version()
+		TriggerStatusUpdate.objects.create(trigger=t2, text="Update.", text_format=TextFormat.Markdown)
+		self.assertNotEqual(Trigger.objects.get(id=t2.id).get_cache_version(), v2)
+
+	def test_geocode_pledge_executions(self):
+		from contrib.legislative import geocode_pledge_executions, LocalGeocoder
+		from django.utils.timezone import now
+
+		pledges = [self._create_pledge("test%d@example.com" % i, 0, 10, 0, None) for i in range(3)]
+		self.test_trigger_execution()
+		Pledge.ENFORCE_EXECUTION_EMAIL_DELAY = False
+		for p in pledges:
+			p.pre_execution_email_sent_at = now()
+			p.save()
+			p.execute()
+
+		# The report is generated as soon as the trigger is done executing,
+		# which is before geocoding.
+		import json, tempfile
+		from django.test.utils import override_settings
+		from contrib.reports import get_trigger_execution_report_file
+		with tempfile.TemporaryDirectory() as report_dir, override_settings(TRIGGER_REPORT_DIR=report_dir):
+			with open(get_trigger_execution_report_file(Trigger.objects.get(key="test").execution)) as f:
+				report = json.load(f)
+			self.assertEqual(set(d["congressional_district"] for d in report["donors"]), set([None]))
+
+			# All of the pledges have the same address, so it is geocoded once.
+			geocoder = LocalGeocoder({ "00000": "NY01" })
+			self.assertEqual(geocode_pledge_executions(PledgeExecution.objects.all(), geocoder=geocoder, workers=2, batch_size=2, log=lambda msg : None), 3)
+			self.assertEqual(geocoder.calls, 1)
+			self.assertEqual(PledgeExecution.objects.filter(district="NY01").count(), 3)
+
+			# The report now has the districts.
+			with open(get_trigger_execution_report_file(Trigger.objects.get(key="test").execution)) as f:
+				report = json.load(f)
+			self.assertEqual([d["congressional_district"] for d in report["donors"]], ["NY01"] * 3)
+
+		te = Trigger.objects.get(key="test").execution
+		aggs = { (a.outcome, a.district): a.total for a in ContributionAggregate.objects.filter(trigger_execution=te) }
+		self.assertEqual(aggs[(None, "NY01")], te.total_contributions)
+		self.assertEqual(aggs[(None, None)], te.total_contributions)
+
+	def test_execution_engine_stops_on_error(self):
+		# An unexpected error stops the run, and the pledge that failed
+		# is not executed again on resume without being asked to because
+		# its card may have been charged.
+		import contrib.bizlogic, tempfile, os
+		from contrib.execution import PledgeExecutionEngine
+		from django.utils.timezone import now
+
+		pledges = [self._create_pledge("test%d@example.com" % i, 0, 10, 0, None) for i in range(2)]
+		self.test_trigger_execution()
+		Pledge.ENFORCE_EXECUTION_EMAIL_DELAY = False
+		for p in pledges:
+			p.pre_execution_email_sent_at = now()
+			p.save()
+		pledge_ids = [p.id for p in pledges]
+
+		class FailingDemocracyEngineAPI(object):
+			def create_donation(self, info):
+				raise IOError("Connection timed out.")
+
+		fd, path = tempfile.mkstemp()
+		os.close(fd)
+		api = contrib.bizlogic.DemocracyEngineAPI
+		try:
+			contrib.bizlogic.DemocracyEngineAPI = FailingDemocracyEngineAPI()
+			log = []
+			summary = PledgeExecutionEngine(checkpoint=path, log=log.append).run(pledge_ids)
+			self.assertEqual(summary.counts, { "done": 0, "skipped": 0, "error": 1 })
+			self.assertEqual(Pledge.objects.filter(status=PledgeStatus.Open).count(), 2)
+
+			# On resume the failed pledge is held back and the other one runs.
+			contrib.bizlogic.DemocracyEngineAPI = api
+			log = []
+			summary = PledgeExecutionEngine(checkpoint=path, log=log.append).run(pledge_ids)
+			self.assertEqual(summary.counts, { "done": 1, "skipped": 0, "error": 0 })
+			self.assertIn("\t%d" % pledge_ids[0], log)
+			self.assertEqual(Pledge.objects.get(id=pledge_ids[0]).status, PledgeStatus.Open)
+			self.assertEqual(Pledge.objects.get(id=pledge_ids[1]).status, PledgeStatus.Executed)
+
+			# Until we say it is safe.
+			summary = PledgeExecutionEngine(checkpoint=path, retry_in_flight=True, log=log.append).run(pledge_ids[:1])
+			self.assertEqual(summary.counts, { "done": 1, "skipped": 0, "error": 0 })
+			self.assertEqual(Pledge.objects.get(id=pledge_ids[0]).status, PledgeStatus.Executed)
+		finally:
+			contrib.bizlogic.DemocracyEngineAPI = api
+			os.unlink(path)
+
+	def test_send_pre_execution_emails(self):
+		# Pre-execution emails are sent in batches, with one UPDATE per
+		# batch to record that they were sent, and the charge is computed
+		# once for all of the pledges with the same trigger, filters and
+		# amount.
+		from django.core import mail
+		from django.db import connection
+		from django.test.utils import CaptureQueriesContext
+		from contrib.management.commands.send_pledge_emails import Command
+
+		pledges = [self._create_pledge("test%d@example.com" % i, 0, 10, 0, None) for i in range(5)]
+		self.test_trigger_execution()
+
+		cmd = Command()
+		cmd.BATCH_SIZE = 2
+		mail.outbox = []
+		with CaptureQueriesContext(connection) as queries:
+			cmd.send_pledge_emails('pre')
+		self.assertEqual(sorted(m.to[0] for m in mail.outbox), sorted(p.user.email for p in pledges))
+		self.assertEqual(len(cmd.charges), 1)
+		self.assertEqual(len([q for q in queries if q['sql'].startswith('UPDATE') and 'pre_execution_email_sent_at' in q['sql']]), 3)
+		self.assertEqual(Pledge.objects.filter(pre_execution_email_sent_at=None).count(), 0)
+
+		# Nothing is sent twice.
+		mail.outbox = []
+		cmd.send_pledge_emails('pre')
+		self.assertEqual(len(mail.outbox), 0)
+
+	def test_pledge_execution_query_count(self):
+		# The number of queries to execute a pledge should not depend on
+		# how many recipients it has.
+		from django.db import connection
+		from django.test.utils import CaptureQueriesContext
+		from django.utils.timezone import now
+
+		# The first pledge is executed just to create the per-district
+		# ContributionAggregate rows, so that the pledges we measure do
+		# the same work.
+		pledges = [
+			self._create_pledge("test%d@example.com" % i, 0, 10, incumb_challgr, None)
+			for i, incumb_challgr in enumerate((0, 1, 0))]
+		self.test_trigger_execution()
+		Pledge.ENFORCE_EXECUTION_EMAIL_DELAY = False
+
+		query_counts = []
+		num_contribs = []
+		for p in pledges:
+			p.pre_execution_email_sent_at = now()
+			p.save()
+			with CaptureQueriesContext(connection) as queries:
+				p.execute()
+			query_counts.append(len(queries))
+			num_contribs.append(p.execution.contributions.count())
+
+		self.assertNotEqual(num_contribs[1], num_contribs[2])
+		self.assertEqual(query_counts[1], query_counts[2])
+
+	def _pledge_execution(self, desired_outcome, amount, incumb_challgr, filter_party, expected_contrib_amount,
+		expected_problem=None, expected_problem_string=None):
+
+		# Create a pledge.
+		p = self._create_pledge("test@example.com", desired_outcome, amount, incumb_challgr, filter_party)
+
+		# Check that the trigger now has a pledge, once its pledge counters
+		# are rolled up as the rollup_pledge_counts command does.
+		Trigger.rollup_pledge_counts(p.trigger_id)
 		t = Trigger.objects.get(key="test")
 		self.assertEqual(t.pledge_count, 1)
 		self.assertEqual(t.total_pledged, p.amount)
@@ -364,3 +557,153 @@ class ExecutionTestCase(TestCase):
 		self.assertEqual(p.trigger.execution.num_contributions, expected_contrib_count)
 		self.assertEqual(p.trigger.execution.total_contributions, p.execution.charged-p.execution.fees)
 
+		# Test the report.
+		import json, tempfile
+		from django.test.utils import override_settings
+		from contrib.reports import get_trigger_execution_report_file
+		with tempfile.TemporaryDirectory() as report_dir, override_settings(TRIGGER_REPORT_DIR=report_dir):
+			with open(get_trigger_execution_report_file(Trigger.objects.get(id=t.id).execution)) as f:
+				report = json.load(f)
+		self.assertEqual(len(report["actors"]), t.execution.actions.count())
+		self.assertEqual(len(report["contributions"]), expected_contrib_count)
+		self.assertEqual(len(report["donors"]), 1)
+		self.assertEqual(report["donors"][0]["desired_outcome"], p.desired_outcome_label)
+
+		# Test that the aggregates stay exact when the district is set.
+		total = p.execution.charged-p.execution.fees
+		p.execution.update_district("NY01", { })
+		aggs = { (a.outcome, a.district): a.total for a in ContributionAggregate.objects.filter(trigger_execution=t.execution) }
+		self.assertEqual(aggs[(None, None)], total)
+		self.assertEqual(aggs[(None, "NY01")], total)
+		self.assertEqual(aggs[(p.desired_outcome, None)], total)
+		self.assertEqual(aggs[(p.desired_outcome, "NY01")], total)
+		self.assertEqual(Trigger.objects.get(id=t.id).execution.total_contributions, total)
+
+
+class ExecutionEngineTestCase(TestCase):
+	def test_resume_skips_in_flight(self):
+		# A pledge that a crashed run submitted but never finished must
+		# not be executed again without being asked to.
+		import tempfile, os
+		from contrib.execution import PledgeExecutionEngine, Checkpoint
+		fd, path = tempfile.mkstemp()
+		os.close(fd)
+		try:
+			cp = Checkpoint(path)
+			cp.record(1, "submitted")
+			cp.record(1, "done")
+			cp.record(2, "submitted")
+			cp.close()
+
+			log = []
+			engine = PledgeExecutionEngine(checkpoint=path, log=log.append)
+			self.assertEqual(engine.filter_resumed([2, 3], Checkpoint(path)), [3])
+			self.assertTrue(any("\t2" == line for line in log))
+
+			engine = PledgeExecutionEngine(checkpoint=path, retry_in_flight=True, log=log.append)
+			self.assertEqual(engine.filter_resumed([2, 3], Checkpoint(path)), [2, 3])
+		finally:
+			os.unlink(path)
+
+class VoteSourceTestCase(TestCase):
+	class StubSession(object):
+		# Stands in for requests.Session. responses is a list of
+		# (status code, headers, content) tuples or exceptions to raise,
+		# one for each request.
+		def __init__(self, responses, requests_made):
+			self.responses = responses
+			self.requests_made = requests_made
+		def mount(self, prefix, adapter):
+			pass
+		def get(self, url, headers=None, timeout=None, stream=False):
+			import io, requests
+			self.requests_made.append((url, headers))
+			resp = self.responses.pop(0)
+			if isinstance(resp, Exception):
+				raise resp
+			r = requests.Response()
+			r.status_code, headers, content = resp
+			r.headers.update(headers)
+			r.url = url
+			r.raw = io.BytesIO(content)
+			return r
+
+	def open_url(self, source, responses):
+		import requests
+		requests_made = []
+		Session = requests.Session
+		requests.Session = lambda : VoteSourceTestCase.StubSession(responses, requests_made)
+		try:
+			with source.open_url("https://www.govtrack.us/congress/votes/114-2015/h1.json") as f:
+				return f.read(), requests_made
+		finally:
+			requests.Session = Session
+
+	def test_govtrack_cache(self):
+		import tempfile, os, requests
+		from contrib.legislative import GovTrackVoteSource
+		with tempfile.TemporaryDirectory() as cache_dir:
+			source = GovTrackVoteSource("https://www.govtrack.us/congress/votes/114-2015/h1", cache_dir=cache_dir)
+
+			# Nothing is cached yet, so a failure is raised.
+			with self.assertRaises(requests.ConnectionError):
+				self.open_url(source, [requests.ConnectionError()])
+
+			# The first fetch is unconditional.
+			content, requests_made = self.open_url(source, [(200, { "ETag": '"v1"', "Last-Modified": "Wed, 21 Oct 2015 07:28:00 GMT" }, b"version 1")])
+			self.assertEqual(content, b"version 1")
+			self.assertEqual(requests_made[0][1], { })
+
+			# Then the cached copy is revalidated.
+			content, requests_made = self.open_url(source, [(304, { }, b"")])
+			self.assertEqual(content, b"version 1")
+			self.assertEqual(requests_made[0][1], { "If-None-Match": '"v1"', "If-Modified-Since": "Wed, 21 Oct 2015 07:28:00 GMT" })
+
+			# New content is stored by its hash alongside the old.
+			content, requests_made = self.open_url(source, [(200, { "ETag": '"v2"' }, b"version 2")])
+			self.assertEqual(content, b"version 2")
+			self.assertEqual(len(os.listdir(os.path.join(cache_dir, "objects"))), 2)
+
+			# When GovTrack fails, the cached copy is used.
+			content, requests_made = self.open_url(source, [(503, { }, b"Service Unavailable")])
+			self.assertEqual(content, b"version 2")
+			content, requests_made = self.open_url(source, [requests.Timeout()])
+			self.assertEqual(content, b"version 2")
+
+	def test_file_source(self):
+		import tempfile, os, json
+		from contrib.legislative import FileVoteSource
+		with tempfile.TemporaryDirectory() as d:
+			with open(os.path.join(d, "vote.json"), "w") as f:
+				json.dump({ "link": "https://www.govtrack.us/congress/votes/114-2015/h1" }, f)
+			with open(os.path.join(d, "vote.xml"), "wb") as f:
+				f.write(b"<vote/>")
+			source = FileVoteSource(os.path.join(d, "vote.json"), os.path.join(d, "vote.xml"))
+			self.assertEqual(source.get_vote()["link"], "https://www.govtrack.us/congress/votes/114-2015/h1")
+			with source.open_voters_xml() as f:
+				self.assertEqual(f.read(), b"<vote/>")
+
+class AsyncDemocracyEngineTestCase(TestCase):
+	def test_concurrent_calls(self):
+		# Calls made through the async client overlap.
+		import asyncio, time
+		import contrib.bizlogic
+		from contrib.bizlogic import AsyncDemocracyEngineAPI, DummyDemocracyEngineAPI, coroutine
+		sync_api = contrib.bizlogic.DemocracyEngineAPI
+		contrib.bizlogic.DemocracyEngineAPI = DummyDemocracyEngineAPI(latency=.1)
+		api = AsyncDemocracyEngineAPI(concurrency=10)
+		@coroutine
+		def run():
+			return (yield from asyncio.gather(*[api.create_donation({ "token_request": True }) for i in range(10)]))
+		loop = asyncio.new_event_loop()
+		asyncio.set_event_loop(loop)
+		start = time.time()
+		try:
+			results = loop.run_until_complete(run())
+		finally:
+			asyncio.set_event_loop(None)
+			loop.close()
+			api.close()
+			contrib.bizlogic.DemocracyEngineAPI = sync_api
+		self.assertLess(time.time() - start, .5)
+		self.assertEqual(len(set(r['token'] for r in results)), 10)
@@ -10,16 +10,18 @@ def query_json_api(base_url, params):
 	req = urllib.request.urlopen(url)
 	return json.loads(req.read().decode("utf-8"))
 
+class JSONEncoder(json.JSONEncoder):
+	# Also serializes Decimals and datetimes.
+	def default(self, o):
+		import decimal
+		if isinstance(o, decimal.Decimal):
+			return float(o)
+		if isinstance(o, datetime.datetime):
+			return o.isoformat()
+		return super(JSONEncoder, self).default(o)
+
 def build_json_httpresponse(obj):
-	import decimal
-	class MyEncoder(json.JSONEncoder):
-		def default(self, o):
-			if isinstance(o, decimal.Decimal):
-				return float(o)
-			if isinstance(o, datetime.datetime):
-				return o.isoformat()
-			return super(MyEncoder, self).default(o)
-	ret = json.dumps(obj, cls=MyEncoder, sort_keys=True, indent=2)
+	ret = json.dumps(obj, cls=JSONEncoder, sort_keys=True, indent=2)
 	resp = HttpResponse(ret, content_type="application/json")
 	resp["Content-Length"] = len(ret)
 	return resp
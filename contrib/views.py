@@ -1,10 +1,10 @@
 from django.shortcuts import render, redirect, get_object_or_404
 from django.views.decorators.http import require_http_methods
 from django.views.decorators.csrf import csrf_exempt
-from django.db import transaction
+from django.db import transaction, IntegrityError
 from django.dispatch import receiver
 from django.contrib import messages
-from django.http import HttpResponse, HttpResponseRedirect, HttpResponseForbidden, Http404
+from django.http import HttpResponse, HttpResponseRedirect, HttpResponseForbidden, Http404, StreamingHttpResponse
 from django.conf import settings
 
 from email_confirm_la.signals import post_email_confirm
@@ -15,17 +15,22 @@ from contrib.models import Trigger, TriggerStatus, TriggerExecution, Pledge, Ple
 from contrib.utils import json_response
 from contrib.bizlogic import HumanReadableValidationError, run_authorization_test
 
-import copy
+import os.path
 import rtyaml
 import random
 
 # Used by unit tests to override the suggested pledge.
 SUGGESTED_PLEDGE_AMOUNT = None
 
+# How long rendered parts of a trigger page are cached. They're keyed on
+# the trigger's cache version, so this only bounds how long unused
+# versions stay in the cache.
+TRIGGER_PAGE_CACHE_TIME = 60*60*24
+
 @anonymous_view
 def trigger(request, id, slug):
 	# get the object
-	trigger = get_object_or_404(Trigger, id=id)
+	trigger = get_object_or_404(Trigger.objects.select_related('execution'), id=id)
 
 	# redirect to canonical URL if slug does not match
 	if trigger.slug != slug:
@@ -35,14 +40,16 @@ def trigger(request, id, slug):
 	# but for which there were no pledges that resulted in transactions, so use
 	# zeros instead of None's where needed.
 
-	outcomes = None
-	actions = None
-	avg_pledge = 0
-	avg_contrib = 0
-	num_contribs = None
-	num_recips = 0
-	num_actors = 0
-	by_incumb_chlngr = []
+	summary = {
+		"outcomes": None,
+		"actions": None,
+		"avg_pledge": 0,
+		"avg_contrib": 0,
+		"num_contribs": None,
+		"num_recips": 0,
+		"num_actors": 0,
+		"by_incumb_chlngr": [],
+	}
 
 	try:
 		te = trigger.execution
@@ -50,62 +57,26 @@ def trigger(request, id, slug):
 		te = None
 
 	if te and te.pledge_count_with_contribs > 0 and te.pledge_count >= .75 * trigger.pledge_count:
-		# Get the contribution aggregates by outcome and sort by total amount of contributions.
-		outcomes = te.get_outcomes()
-
-		# Actions/Actors. Sort with actors that received no contributions either for or against at
-		# the end of the list, since they're sort of no-data rows. After that, sort by the sum of
-		# the contributions plus the negative of the contributions to their challengers. For ties,
-		# sort alphabetically on name.
-		actions = list(te.actions.all().select_related('actor'))
-		actions.sort(key = lambda a : (
-			a.outcome is None, # non-voting actors at the end
-			(a.total_contributions_for + a.total_contributions_against) == 0, # no contribs either way at end
-			-(a.total_contributions_for - a.total_contributions_against), # sort by contribs for minus contribs against
-			a.reason_for_no_outcome, # among non-voting actors, sort by the reason
-			a.outcome, # among voting actors, group by vote
-			a.actor.name_sort # finally, by last name
-			)
-		)
-		num_recips = 0
-		num_actors = 0
-		for a in actions:
-			if a.total_contributions_for > 0: num_recips += 1
-			if a.total_contributions_against > 0: num_recips += 1
-			if a.total_contributions_for > 0 or a.total_contributions_against > 0: num_actors += 1
-
-		# Incumbent/challengers.
-		by_incumb_chlngr = [["Incumbent", 0, "text-success"], ["Opponent", 0, "text-danger"]]
-		for a in actions:
-			by_incumb_chlngr[0][1] += a.total_contributions_for
-			by_incumb_chlngr[1][1] += a.total_contributions_against
-
-		# Compute other summary stats.
-		num_contribs = te.num_contributions
-		avg_pledge = te.total_contributions / te.pledge_count_with_contribs
-		avg_contrib = te.total_contributions / num_contribs
+		# Get the summary stats, which are computed once and cached when the
+		# trigger is done executing.
+		summary = te.get_summary()
 	else:
 		# If the trigger has been executed but not enough pledges
 		# have completed being executed yet, then pretend like
 		# nothing has been executed.
 		te = None
 
-	return render(request, "contrib/trigger.html", {
+	context = {
 		"trigger": trigger,
 		"execution": te,
-		"outcomes": outcomes,
 		"alg": Pledge.current_algorithm(),
 		"min_contrib": trigger.get_minimum_pledge(),
 		"suggested_pledge": SUGGESTED_PLEDGE_AMOUNT or random.choice([5, 10]),
-		
-		"actions": actions,
-		"by_incumb_chlngr": by_incumb_chlngr,
-		"avg_pledge": avg_pledge,
-		"num_contribs": num_contribs,
-		"num_recips": num_recips,
-		"num_actors": num_actors,
-		"avg_contrib": avg_contrib,
-	})
+		"cache_version": trigger.get_cache_version(),
+		"cache_time": TRIGGER_PAGE_CACHE_TIME,
+	}
+	context.update(summary)
+	return render(request, "contrib/trigger.html", context)
 
 @user_view_for(trigger)
 def trigger_user_view(request, id, slug):
@@ -128,19 +99,18 @@ def trigger_user_view(request, id, slug):
 		# it was.)
 		import django.template
 		template = django.template.loader.get_template("contrib/contrib.html")
-		pe = PledgeExecution.objects.filter(pledge=p).first()
-		contribs = sorted(Contribution.objects.filter(pledge_execution=pe).select_related("action"), key=lambda c : (c.recipient.is_challenger, c.action.name_sort))
-
-		# Also include recommendations for further actions.
-		recs = []
-		for t in Trigger.objects.filter(status=TriggerStatus.Open).order_by('-total_pledged'):
-			# Not something the user already took action on (including this pledge!).
-			if p.user is not None and t.pledges.filter(user=p.user).exists(): continue
-			if p.email is not None and t.pledges.filter(email=p.email).exists(): continue
-			# Get up to three.
-			recs.append(t)
-			if len(recs) == 3:
-				break
+		p.trigger = trigger # save a query in the template
+		try:
+			pe = p.execution
+		except PledgeExecution.DoesNotExist:
+			pe = None
+		contribs = []
+		if pe:
+			contribs = sorted(pe.contributions.select_related("action", "recipient"), key=lambda c : (c.recipient.is_challenger, c.action.name_sort))
+
+		# Also include recommendations for further actions. They're only
+		# shown while the pledge is not yet executed.
+		recs = get_recommended_triggers(p) if not pe else []
 
 		ret["pledge_made"] = template.render(django.template.Context({
 			"trigger": trigger,
@@ -153,6 +123,40 @@ def trigger_user_view(request, id, slug):
 
 	return ret
 
+RECOMMENDATION_POOL_SIZE = 25
+RECOMMENDATION_POOL_CACHE_TIME = 60*5
+
+def get_recommended_triggers(pledge, count=3):
+	# Returns up to count open triggers, with the most pledged first,
+	# that the user who made the pledge hasn't taken action on yet
+	# (including this pledge!).
+	from django.core.cache import cache
+
+	def open_triggers_not_pledged():
+		qs = Trigger.objects.filter(status=TriggerStatus.Open)
+		if pledge.user_id is not None: qs = qs.exclude(pledges__user=pledge.user_id)
+		if pledge.email is not None: qs = qs.exclude(pledges__email=pledge.email)
+		return qs
+
+	# The most pledged open triggers are the same for everyone, so
+	# keep a short ranked list of them in the cache.
+	pool = cache.get("recommendation_pool")
+	if pool is None:
+		pool = list(Trigger.objects.filter(status=TriggerStatus.Open)
+			.order_by('-total_pledged').values_list('id', flat=True)[0:RECOMMENDATION_POOL_SIZE])
+		cache.set("recommendation_pool", pool, RECOMMENDATION_POOL_CACHE_TIME)
+
+	# Remove the triggers the user already pledged on in one query.
+	recs = open_triggers_not_pledged().in_bulk(pool)
+	recs = [recs[id] for id in pool if id in recs][0:count]
+
+	# If the user has pledged on nearly every trigger in the pool, look
+	# past it.
+	if len(recs) < count and len(pool) == RECOMMENDATION_POOL_SIZE:
+		recs = list(open_triggers_not_pledged().order_by('-total_pledged')[0:count])
+
+	return recs
+
 @require_http_methods(['POST'])
 @json_response
 def get_user_defaults(request):
@@ -209,10 +213,9 @@ def get_recent_pledge_defaults(user, request):
 		elif isinstance(ret[field], ActorParty):
 			ret[field] = str(ret[field])
 
-	# Copy contributor fields from the extra dict.
-	for field in ('contribNameFirst', 'contribNameLast', 'contribAddress', 'contribCity', 'contribState', 'contribZip',
-		'contribOccupation', 'contribEmployer'):
-		ret[field] = pledge.extra['contributor'][field]
+	# Copy contributor fields.
+	for field, column in Pledge.CONTRIBUTOR_FIELDS:
+		ret[field] = getattr(pledge, column)
 
 	# Return a summary of billing info to show how we would bill.
 	ret['cclastfour'] = pledge.cclastfour
@@ -262,7 +265,6 @@ def submit(request):
 	except HumanReadableValidationError as e:
 		return { "status": "error", "message": str(e) }
 
-@transaction.atomic
 def create_pledge(request):
 	p = Pledge()
 
@@ -320,15 +322,10 @@ def create_pledge(request):
 		except ValueError:
 			raise Exception("%s is out of range" % field)
 
-	# string fields that go straight into the extras dict.
-	p.extra = {
-		'contributor': { }
-	}
-	for field in (
-		'contribNameFirst', 'contribNameLast',
-		'contribAddress', 'contribCity', 'contribState', 'contribZip',
-		'contribOccupation', 'contribEmployer'):
-		p.extra['contributor'][field] = request.POST[field].strip()
+	# contributor string fields
+	for field, column in Pledge.CONTRIBUTOR_FIELDS:
+		setattr(p, column, request.POST[field].strip())
+	p.extra = { }
 
 	# normalize the filter_party field
 	if request.POST['filter_party'] in ('DR', 'RD'):
@@ -351,13 +348,6 @@ def create_pledge(request):
 	if p.filter_party == ActorParty.Independent:
 		raise Exception("filter_party is out of range")
 
-	# Save so we get a pledge ID so we can store that in the transaction test.
-	try:
-		p.save()
-	except Exception as e:
-		# Re-wrap into something @json_response will catch.
-		raise ValueError("Something went wrong: " + str(e))
-
 	if not request.POST["billingFromPledge"]:
 		# Get and do simple validation on the billing fields.
 		ccnum = request.POST['billingCCNum'].replace(" ", "").strip() # Stripe's javascript inserts spaces
@@ -375,13 +365,14 @@ def create_pledge(request):
 		# Perform an authorization test on the credit card and store some CC
 		# details in the pledge object.
 		#
-		# This may raise all sorts of exceptions, which will cause the database
-		# transaction to roll back. A HumanReadableValidationError will be caught
-		# in the calling function and shown to the user. Other exceptions will
-		# just generate generic unhandled error messages.
+		# This is a slow network call, so it's done before the pledge is
+		# saved and outside of any database transaction, so that no locks
+		# are held while we wait. (The pledge doesn't have an ID yet to
+		# include in the logging info.)
 		#
-		# Note that any exception after this point is okay because the authorization
-		# will expire on its own anyway.
+		# This may raise all sorts of exceptions. A HumanReadableValidationError
+		# will be caught in the calling function and shown to the user. Other
+		# exceptions will just generate generic unhandled error messages.
 		run_authorization_test(p, ccnum, ccexpmonth, ccexpyear, cccvc, aux_data)
 
 	else:
@@ -393,31 +384,57 @@ def create_pledge(request):
 			id=request.POST["billingFromPledge"],
 			user=p.user)
 
-		# Copy all of the billing fields forward.
-		p.extra['billing'] = copy.deepcopy(prev_p.extra['billing'])
+		# Share the billing profile.
+		p.billing_profile = prev_p.billing_profile
 		p.cclastfour = prev_p.cclastfour
+		p.cc_fingerprint = prev_p.cc_fingerprint
+
+		# Record where we got the info from.
+		p.extra["billing_via_pledge"] = prev_p.id
 
-		# Record where we got the info from. Also signals that the "authorization"
-		# field was copied from a previous pledge.
-		p.extra['billing']["via_pledge"] = prev_p.id
+	# Now save the pledge (and update the trigger's counters) and do the
+	# things that go with it in a short transaction, so that if any of
+	# them fails the pledge isn't made.
+	try:
+		with transaction.atomic():
+			try:
+				p.save()
+			except IntegrityError:
+				raise
+			except Exception as e:
+				# Re-wrap into something @json_response will catch.
+				raise ValueError("Something went wrong: " + str(e))
+
+			if not p.user:
+				# The pledge needs to get confirmation of the user's email address,
+				# which will lead to account creation.
+				p.send_email_confirmation(first_try=True)
+
+				# Wipe the IncompletePledge because the user finished the form.
+				IncompletePledge.objects.filter(email=p.email, trigger=p.trigger).delete()
+
+	except IntegrityError as e:
+		# If we did an authorization test, nothing uses its token now. An
+		# authorization test doesn't create a transaction that could be
+		# voided (its authorization just expires), so there is nothing to
+		# undo.
+
+		# If the user submitted the form twice at once, the other request
+		# made the pledge.
+		if Pledge.objects.filter(trigger=p.trigger, **exists_filters).exists():
+			return { "status": "ok" }
 
-	p.save()
+		# Re-wrap into something @json_response will catch.
+		raise ValueError("Something went wrong: " + str(e))
 
 	if not p.user:
-		# The pledge needs to get confirmation of the user's email address,
-		# which will lead to account creation.
-		p.send_email_confirmation(first_try=True)
-
-		# And in order for the user to be able to view the pledge on the
-		# next page, prior to email confirmation, we'll need to set a token
-		# to grant permission. Only hold up to 20 values.
+		# In order for the user to be able to view the pledge on the next
+		# page, prior to email confirmation, we'll need to set a token to
+		# grant permission. Only hold up to 20 values.
 		request.session['anon_pledge_created'] = \
 			request.session.get('anon_pledge_created', [])[-20:] \
 			+ [p.id]
 
-		# Wipe the IncompletePledge because the user finished the form.
-		IncompletePledge.objects.filter(email=p.email, trigger=p.trigger).delete()
-
 	# If the user had good authentication but wasn't logged in yet, log them
 	# in now. This messes up the CSRF token but the client should redirect to
 	# a new page anyway.
@@ -483,67 +500,25 @@ def cancel_pledge(request):
 	return { "status": "ok" }
 
 @anonymous_view
-@json_response
 def trigger_execution_report(request, id):
 	# get the object & validate that there is data
-	trigger = get_object_or_404(Trigger, id=id)
+	trigger = get_object_or_404(Trigger.objects.select_related('execution'), id=id)
 	try:
 		te = trigger.execution
 	except TriggerExecution.DoesNotExist:
 		raise Http404("This trigger is not executed.")
 	if te.pledge_count_with_contribs == 0:
 		raise Http404("This trigger did not have any contributions.")
-	if te.pledge_count != trigger.pledge_count:
+	if not te.is_complete():
 		raise Http404("This trigger is still being executed.")
 
-	# form response
-	ret = { }
-
-	# Aggregates by outcome.
-	ret['outcomes'] = te.get_outcomes()
-
-	# Aggregates by actor.
-	actions = list(te.actions.all().select_related('actor'))
-	actions.sort(key = lambda a : ((a.total_contributions_for + a.total_contributions_against) == 0, -(a.total_contributions_for - a.total_contributions_against), a.actor.name_sort))
-	def build_actor_info(action):
-		ret = {
-			"name": action.name_long,
-			"action": action.outcome_label(),
-			"contribs": action.total_contributions_for,
-			"contribs_to_opponent": action.total_contributions_against,
-			"actor_id": action.actor.id,
-		}
-		for idscheme in ('bioguide', 'govtrack', 'opensecrets'):
-			if idscheme in action.extra['legislators-current']['id']:
-				ret[idscheme+"_id"] = action.extra['legislators-current']['id'][idscheme]
-		for key in ('state', 'district', 'url', 'end'):
-			v = action.extra['legislators-current']['term'].get(key)
-			if key == 'url': key = 'homepage'
-			if key == 'end': key = 'term_end'
-			if v:
-				ret[key] = v
-		return ret
-	ret['actors'] = [build_actor_info(a) for a in actions]
-
-	# All donors.
-	from contrib.models import PledgeExecutionProblem, Contribution
-	ret['donors'] = [{
-		"desired_outcome": pe.pledge.desired_outcome_label,
-		"contribs": pe.charged-pe.fees,
-		"congressional_district": pe.district,
-		"date": pe.pledge.created,
-	} for pe in te.pledges.filter(problem=PledgeExecutionProblem.NoProblem).select_related('pledge', 'pledge__trigger')]
-
-	# All contributions.
-	ret['contributions'] = [{
-		'amount': c.amount,
-		'donor_congressional_district': c.pledge_execution.district,
-		'donor_desired_outcome': c.pledge_execution.pledge.desired_outcome_label,
-		'recipient_name': c.recipient.name,
-		'recipient_actor_id' if not c.recipient.is_challenger else "incumbent_actor_id":
-			c.recipient.actor_id,
-	} for c in Contribution.objects.filter(pledge_execution__pledge__trigger=trigger)
-		.select_related('pledge_execution', 'pledge_execution__pledge', 'pledge_execution__pledge_trigger', 'recipient')]
-
-	# report
-	return ret
+	# The report is generated once into a file and then streamed from it.
+	from contrib.reports import get_trigger_execution_report_file
+	fn = get_trigger_execution_report_file(te)
+	def read_chunks(f):
+		with f:
+			for chunk in iter(lambda : f.read(65536), b''):
+				yield chunk
+	resp = StreamingHttpResponse(read_chunks(open(fn, 'rb')), content_type="application/json")
+	resp["Content-Length"] = os.path.getsize(fn)
+	return resp
@@ -146,3 +146,8 @@ DE_API = environment['democracyengine']
 CDYNE_API_KEY = environment['cdyne_key']
 MIXPANEL_ID = environment.get('mixpanel_id')
 CURRENT_ELECTION_CYCLE = 2016
+GOVTRACK_CACHE_DIR = local('govtrack-cache')
+TRIGGER_REPORT_DIR = local('trigger-reports')
+# The key for the stored credit card fingerprints. It is separate from
+# SECRET_KEY so that rotating that doesn't orphan every fingerprint.
+CC_FINGERPRINT_KEY = environment['cc-fingerprint-key']
@@ -3,20 +3,37 @@ from django.utils import safestring
 from django.template.defaultfilters import stringfilter
 import markdown2
 import json as jsonlib
+import functools, hashlib
 
 register = template.Library()
 
+# Rendering Markdown is slow and the same few texts (trigger descriptions,
+# etc.) are rendered over and over, so the rendered HTML is memoized in
+# this process and in the Django cache, keyed on a hash of the text.
+MARKDOWN_LRU_SIZE = 512
+MARKDOWN_CACHE_TIME = 60*60*24*7
+
+@functools.lru_cache(maxsize=MARKDOWN_LRU_SIZE)
+def render_markdown(value):
+	from django.core.cache import cache
+	key = "markdown:%s:%s" % (markdown2.__version__, hashlib.sha1(value.encode("utf8")).hexdigest())
+	html = cache.get(key)
+	if html is None:
+		html = markdown2.markdown(value, safe_mode=True)
+		cache.set(key, html, MARKDOWN_CACHE_TIME)
+	return html
+
 @register.filter(is_safe=True)
 @stringfilter
 def render_text(value, format):
 	if str(format) in 'TextFormat.Markdown':
-		return safestring.mark_safe(markdown2.markdown(value, safe_mode=True))
+		return safestring.mark_safe(render_markdown(value))
 	return safestring.mark_safe(value)
 
 @register.filter(is_safe=True)
 @stringfilter
 def markdown(value):
-	return safestring.mark_safe(markdown2.markdown(value, safe_mode=True))
+	return safestring.mark_safe(render_markdown(value))
 
 @register.filter(is_safe=True)
 def json(value):
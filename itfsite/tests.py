@@ -136,7 +136,9 @@ class SimulationTest(StaticLiveServerTestCase):
 			self.browser.find_element_by_css_selector("#pledge-explanation").text,
 			"You have scheduled a campaign contribution of $12.00 for this vote. It will be split among up to 435 representatives, each getting a part of your contribution if they vote Yes on S. 1, but if they vote No on S. 1 their part of your contribution will go to their next general election opponent.")
 
-		# Check the trigger.
+		# Check the trigger, once its pledge counters are rolled up as the
+		# rollup_pledge_counts command does.
+		Trigger.rollup_pledge_counts(t.id)
 		t = Trigger.objects.get(id=t.id) # refresh
 		self.assertEqual(t.pledge_count, 1)
 		self.assertEqual(t.total_pledged, Decimal('12'))
@@ -195,7 +197,9 @@ class SimulationTest(StaticLiveServerTestCase):
 			self.browser.find_element_by_css_selector("#pledge-explanation").text,
 			"You have scheduled a campaign contribution of $12.00 for this vote. It will be split among up to 100 senators, each getting a part of your contribution if they vote No on S. 1, but if they vote Yes on S. 1 their part of your contribution will go to their next general election opponent.")
 
-		# Check the trigger.
+		# Check the trigger, once its pledge counters are rolled up as the
+		# rollup_pledge_counts command does.
+		Trigger.rollup_pledge_counts(t.id)
 		t = Trigger.objects.get(id=t.id) # refresh
 		self.assertEqual(t.pledge_count, 1)
 		self.assertEqual(t.total_pledged, Decimal('12'))
@@ -1,26 +1,69 @@
-from django.db.models import Sum
 from django.shortcuts import render
 from django.contrib.auth.decorators import login_required
 
 from contrib.models import Pledge, PledgeExecution, PledgeStatus
 
+USER_HOME_PLEDGES_PER_PAGE = 25
+HOMEPAGE_OPEN_TRIGGERS_PER_PAGE = 12
+HOMEPAGE_RECENT_TRIGGERS = 8
+
 def homepage(request):
 	# The site homepage.
+	from django.core.cache import cache
+	from contrib.models import Trigger
+
+	page = request.GET.get('page', '1')
+	page = max(1, int(page)) if page.isdigit() else 1
+
+	# The listings are cached until a trigger changes status or finishes
+	# executing.
+	version = Trigger.get_homepage_cache_version()
+	def get_context(page):
+		key = "homepage:%s:%d" % (version, page)
+		context = cache.get(key)
+		if context is None:
+			context = get_homepage_context(page)
+			cache.set(key, context, Trigger.HOMEPAGE_CACHE_TIME)
+		return context
+
+	# Clamp the page number to the pages that exist (which the first page
+	# knows) so that arbitrary page numbers don't each get cached.
+	context = get_context(1)
+	page = min(page, context["open_triggers_num_pages"])
+	if page > 1:
+		context = get_context(page)
+
+	return render(request, "itfsite/homepage.html", context)
 
-	# Get all of the open triggers that a user might participate in.
+def get_homepage_context(page):
+	from django.core.paginator import Paginator, EmptyPage
+	from django.db.models import F
 	from contrib.models import Trigger, TriggerStatus
-	open_triggers = Trigger.objects.filter(status=TriggerStatus.Open).order_by('-total_pledged')
-	recent_executed_triggers = Trigger.objects.filter(status=TriggerStatus.Executed).select_related("execution").order_by('-execution__created')
+
+	# Get the open triggers that a user might participate in, a page at a time.
+	open_triggers = Trigger.objects.filter(status=TriggerStatus.Open).order_by('-total_pledged', '-id')
+	paginator = Paginator(open_triggers, HOMEPAGE_OPEN_TRIGGERS_PER_PAGE)
+	try:
+		open_triggers = paginator.page(page)
+	except EmptyPage:
+		open_triggers = paginator.page(paginator.num_pages)
 
 	# Exclude triggers in the process of being executed from the 'recent' list, because
 	# that list shows aggregate stats that are not yet valid
-	recent_executed_triggers = [t for t in recent_executed_triggers
-		if t.pledge_count == t.execution.pledge_count]
+	recent_executed_triggers = list(Trigger.objects.filter(status=TriggerStatus.Executed, execution__pledge_count=F('pledge_count'))
+		.select_related("execution").order_by('-execution__created')[0:HOMEPAGE_RECENT_TRIGGERS])
+	for t in recent_executed_triggers:
+		t.execution_outcomes = t.execution.get_outcomes()
 
-	return render(request, "itfsite/homepage.html", {
-		"open_triggers": open_triggers,
+	# Only plain data goes into the cache, not the Paginator's queryset.
+	return {
+		"open_triggers": list(open_triggers.object_list),
+		"open_triggers_page": open_triggers.number,
+		"open_triggers_num_pages": paginator.num_pages,
+		"open_triggers_previous_page": open_triggers.previous_page_number() if open_triggers.has_previous() else None,
+		"open_triggers_next_page": open_triggers.next_page_number() if open_triggers.has_next() else None,
 		"recent_executed_triggers": recent_executed_triggers,
-	})
+	}
 
 def simplepage(request, pagename):
 	# Renders a page that has no special processing.
@@ -30,61 +73,38 @@ def simplepage(request, pagename):
 
 @login_required
 def user_home(request):
-	# Get the user's pledges.
-	pledges = Pledge.objects.filter(user=request.user).order_by('-created').prefetch_related()
-	
-	# Get the user's total amount of open pledges, i.e. their total possible
-	# future credit card charges / campaign contributions.
-	total_pledged = pledges.filter(status=PledgeStatus.Open)
-	if len(total_pledged) == 0:
-		total_pledged = 0.0
-	else:
-		total_pledged = total_pledged.aggregate(total_pledged=Sum('amount'))['total_pledged']
+	# Get the user's pledges, a page at a time.
+	from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
+	pledges = Pledge.objects.filter(user=request.user).order_by('-created')\
+		.select_related('trigger', 'trigger__trigger_type', 'execution')
+	paginator = Paginator(pledges, USER_HOME_PLEDGES_PER_PAGE)
+	try:
+		pledges = paginator.page(request.GET.get('page', 1))
+	except PageNotAnInteger:
+		pledges = paginator.page(1)
+	except EmptyPage:
+		pledges = paginator.page(paginator.num_pages)
 
-	# Get the user's total amount of executed campaign contributions.
-	total_contribs = pledges.filter(status=PledgeStatus.Executed)
-	if len(total_contribs) == 0:
-		total_contribs = 0.0
-	else:
-		total_contribs = total_contribs.aggregate(total_contribs=Sum('execution__charged'))['total_contribs']
+	# Get the user's total amount of open pledges and executed campaign
+	# contributions, and their number of pledges by status.
+	summary = Pledge.get_user_summary(request.user)
 
 	return render(request, "itfsite/home.html", {
 		'pledges': pledges,
-		'total_pledged': total_pledged,
-		'total_contribs': total_contribs,
+		'total_pledged': summary['total_pledged'],
+		'total_contribs': summary['total_contribs'],
+		'pledge_counts': summary['counts'],
 		})
 
 @login_required
 def user_contribution_details(request):
-	# Assemble a table of all line-item transactions.
-	items = []
-
-	# Contributions.
+	# Assemble a table of all line-item transactions: the contributions
+	# and the fees.
 	from contrib.models import Contribution
-	contribs = Contribution.objects.filter(pledge_execution__pledge__user=request.user).select_related('pledge_execution', 'recipient', 'action', 'pledge_execution__trigger_execution__trigger')
-	def contrib_line_item(c):
-		return {
-			'when': c.pledge_execution.created,
-			'amount': c.amount,
-			'recipient': c.name_long(),
-			'trigger': c.pledge_execution.trigger_execution.trigger,
-			'sort': (c.pledge_execution.created, 1, c.recipient.is_challenger, c.id),
-		}
-	items.extend([contrib_line_item(c) for c in contribs])
-
-	# Fees.
-	def fees_line_item(p):
-		return {
-			'when': p.created,
-			'amount': p.fees,
-			'recipient': 'if.then.fund fees',
-			'trigger': p.trigger_execution.trigger,
-			'sort': (p.created, 0),
-		}
-	items.extend([fees_line_item(p) for p in PledgeExecution.objects.filter(pledge__user=request.user).select_related('trigger_execution__trigger')])
-
-	# Sort all together.
-	items.sort(key = lambda x : x['sort'], reverse=True)
+	from contrib.reports import iter_line_items, line_items_csv_response
+	items = iter_line_items(
+		Contribution.objects.filter(pledge_execution__pledge__user=request.user),
+		PledgeExecution.objects.filter(pledge__user=request.user))
 
 	if request.method == 'GET':
 		# GET => HTML
@@ -93,26 +113,6 @@ def user_contribution_details(request):
 			})
 	else:
 		# POST => CSV
-		from django.http import HttpResponse
-		import csv
-		from io import StringIO
-		buf = StringIO()
-		writer = csv.writer(buf)
-		writer.writerow(['date', 'amount', 'recipient', 'action'])
-		for item in items:
-			writer.writerow([
-				item['when'].isoformat(),
-				item['amount'],
-				item['recipient'],
-				request.build_absolute_uri(item['trigger'].get_absolute_url()),
-				])
-		buf = buf.getvalue().encode('utf8')
-
-		if True:
-			resp = HttpResponse(buf, content_type="text/csv")
-			resp['Content-Disposition'] = 'attachment; filename="contributions.csv"'
-		else:
-			resp = HttpResponse(buf, content_type="text/plain")
-			resp['Content-Disposition'] = 'inline'
-		resp["Content-Length"] = len(buf)
-		return resp
+		return line_items_csv_response(items,
+			lambda trigger : request.build_absolute_uri(trigger.get_absolute_url()),
+			"contributions.csv")